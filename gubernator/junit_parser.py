@@ -0,0 +1,73 @@
+# Copyright 2017 The Kubernetes Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Incremental JUnit XML parsing, shared by gubernator and kettle.
+
+kettle/junit_parser.py is a symlink to this file.
+"""
+
+import cStringIO
+import logging
+
+try:
+    import defusedxml.ElementTree as ET
+except ImportError:
+    import xml.etree.cElementTree as ET
+
+ParseError = ET.ParseError
+
+
+def parse(xml):
+    """Generate (name, time, failure_texts, skipped) for each testcase in a JUnit XML string.
+
+    Both <testsuite> roots and <testsuites> roots are handled. The names of testcases in a
+    <testsuites> root are prefixed by their testsuite's name.
+
+    The document is parsed incrementally, and elements are discarded once they have been
+    read, so memory use doesn't grow with its size.
+
+    Raises:
+        ParseError: the XML is malformed. Testcases before the error have already been
+            generated.
+    """
+    if isinstance(xml, unicode):
+        xml = xml.encode('utf8')
+    root = None
+    suite_name = None
+    stack = []  # open elements
+    # cStringIO reads from the string without copying it, unlike io.BytesIO.
+    for event, elem in ET.iterparse(cStringIO.StringIO(xml), events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+                if root.tag not in ('testsuite', 'testsuites'):
+                    logging.error('unable to find failures, unexpected tag %s', root.tag)
+                    return
+            elif len(stack) == 1 and root.tag == 'testsuites':
+                suite_name = elem.get('name')
+            stack.append(elem)
+            continue
+
+        stack.pop()
+        case_depth = 1 if root.tag == 'testsuite' else 2
+        if elem.tag == 'testcase' and len(stack) == case_depth:
+            name = elem.get('name')
+            if root.tag == 'testsuites':
+                name = '%s %s' % (suite_name, name)
+            yield (name, float(elem.get('time') or 0),
+                   [failure.text for failure in elem.findall('failure')],
+                   elem.find('skipped') is not None)
+        if 0 < len(stack) <= case_depth:
+            # Drop the finished element (and any earlier siblings) from its parent.
+            stack[-1].clear()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+# Copyright 2017 The Kubernetes Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import junit_parser
+
+
+class ParseTest(unittest.TestCase):
+    @staticmethod
+    def parse(xml):
+        return list(junit_parser.parse(xml))
+
+    def test_testsuite(self):
+        self.assertEqual(self.parse('''
+            <testsuite tests="3" failures="1" time="12.5">
+                <properties><property name="go.version" value="go1.8"/></properties>
+                <testcase name="First" time="0"><skipped/></testcase>
+                <testcase name="Second" time="2.5"/>
+                <testcase name="Third" time="10">
+                    <failure>first</failure>
+                    <failure>second</failure>
+                    <system-out>lots of logs</system-out>
+                </testcase>
+                <system-out>more logs</system-out>
+            </testsuite>'''), [
+                ('First', 0.0, [], True),
+                ('Second', 2.5, [], False),
+                ('Third', 10.0, ['first', 'second'], False),
+            ])
+
+    def test_testsuites(self):
+        self.assertEqual(self.parse('''
+            <testsuites>
+                <testsuite name="k8s.io/a">
+                    <properties><property name="go.version" value="go1.8"/></properties>
+                    <testcase name="TestGood" time="0.1"/>
+                    <testcase name="TestBad"><failure>bad</failure></testcase>
+                </testsuite>
+                <testsuite name="k8s.io/b">
+                    <testcase name="TestGood" time="3"/>
+                </testsuite>
+            </testsuites>'''), [
+                ('k8s.io/a TestGood', 0.1, [], False),
+                ('k8s.io/a TestBad', 0.0, ['bad'], False),
+                ('k8s.io/b TestGood', 3.0, [], False),
+            ])
+
+    def test_unicode(self):
+        self.assertEqual(self.parse(u'<testsuite><testcase name="\xe9"/></testsuite>'),
+                         [(u'\xe9', 0.0, [], False)])
+
+    def test_unexpected_root(self):
+        self.assertEqual(self.parse('<body><testcase name="a"/></body>'), [])
+
+    def test_malformed(self):
+        with self.assertRaises(junit_parser.ParseError):
+            self.parse('<testsuite><testcase name="a">')
+
+    def test_large(self):
+        # elements are cleared as they're read, but testcases are all still generated
+        xml = '<testsuite>%s</testsuite>' % ''.join(
+            '<testcase name="t%d" time="1"><system-out>%s</system-out></testcase>'
+            % (n, 'x' * 1000) for n in range(1000))
+        tests = self.parse(xml)
+        self.assertEqual(len(tests), 1000)
+        self.assertEqual(tests[-1], ('t999', 1.0, [], False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,12 +17,11 @@ import json
 import os
 import re
 
-import defusedxml.ElementTree as ET
-
 from google.appengine.api import urlfetch
 
 import gcs_async
 from github import models
+import junit_parser
 import log_parser
 import testgrid
 import view_base
@@ -31,30 +30,18 @@ import view_base
 def parse_junit(xml, filename):
     """Generate failed tests as a series of (name, duration, text, filename) tuples."""
     try:
-        tree = ET.fromstring(xml)
-    except ET.ParseError, e:
+        failed = [test for test in junit_parser.parse(xml) if test[2]]
+    except junit_parser.ParseError, e:
         logging.exception('parse_junit failed for %s', filename)
         try:
-            tree = ET.fromstring(re.sub(r'[\x00\x80-\xFF]+', '?', xml))
-        except ET.ParseError, e:
+            failed = [test for test in junit_parser.parse(re.sub(r'[\x00\x80-\xFF]+', '?', xml))
+                      if test[2]]
+        except junit_parser.ParseError, e:
             yield 'Gubernator Internal Fatal XML Parse Error', 0.0, str(e), filename
             return
-    if tree.tag == 'testsuite':
-        for child in tree:
-            name = child.attrib['name']
-            time = float(child.attrib['time'])
-            for param in child.findall('failure'):
-                yield name, time, param.text, filename
-    elif tree.tag == 'testsuites':
-        for testsuite in tree:
-            suite_name = testsuite.attrib['name']
-            for child in testsuite.findall('testcase'):
-                name = '%s %s' % (suite_name, child.attrib['name'])
-                time = float(child.attrib['time'])
-                for param in child.findall('failure'):
-                    yield name, time, param.text, filename
-    else:
-        logging.error('unable to find failures, unexpected tag %s', tree.tag)
+    for name, time, failure_texts, _ in failed:
+        for text in failure_texts:
+            yield name, time, text, filename
 
 
 @view_base.memcache_memoize('build-log-parsed://', expires=60*60*4)
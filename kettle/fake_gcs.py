@@ -0,0 +1,155 @@
+# Copyright 2017 The Kubernetes Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local stand-in for the parts of the GCS JSON API that make_db uses.
+
+Serves objects from a dict of {'gs://bucket/path': contents}, with optional latency
+and throttling, so clients can be tested and benchmarked without network access:
+
+    server = fake_gcs.FakeGCSServer(objects, latency=0.05, max_active=100)
+    server.start()
+    client_class.API_URL = server.url
+    ...
+    server.stop()
+"""
+
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+
+
+class FakeGCSHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def respond(self, status, body='', content_type='application/octet-stream'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            throttled = server.max_active is not None and server.active >= server.max_active
+            if throttled:
+                server.throttled += 1
+            else:
+                server.active += 1
+        if throttled:
+            self.respond(429, 'slow down')
+            return
+        try:
+            if server.latency:
+                time.sleep(server.latency)
+            self.handle_get()
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def handle_get(self):
+        url = urlparse.urlparse(self.path)
+        params = {k: v[-1] for k, v in urlparse.parse_qs(url.query).iteritems()}
+        parts = url.path.split('/', 6)  # '', 'storage', 'v1', 'b', bucket, 'o', object
+        if parts[1:4] != ['storage', 'v1', 'b'] or len(parts) < 6 or parts[5] != 'o':
+            self.respond(400, 'bad request')
+        elif len(parts) == 7:
+            data = self.server.objects.get('gs://%s/%s' % (parts[4], urllib.unquote(parts[6])))
+            if data is None:
+                self.respond(404, 'not found')
+            else:
+                self.respond(200, data)
+        else:
+            self.respond(200, json.dumps(self.server.list(parts[4], params)),
+                         'application/json')
+
+
+class FakeGCSServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """An HTTP server that answers GCS object gets and listings.
+
+    Args:
+        objects: {'gs://bucket/path': contents}. Contents that aren't strings are
+            served as JSON.
+        latency: seconds to wait before answering each request.
+        max_active: how many requests to serve at once. Requests past this are
+            answered with 429s, like GCS does when its rate limits are exceeded.
+    """
+    daemon_threads = True
+    request_queue_size = 1024  # the default of 5 refuses bursts of new connections
+    PAGE_SIZE = 1000
+
+    def __init__(self, objects, latency=0, max_active=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeGCSHandler)
+        self.objects = {path: data if isinstance(data, str) else json.dumps(data)
+                        for path, data in objects.iteritems()}
+        self.names = {}  # {bucket: sorted object names}
+        for path in self.objects:
+            bucket, name = path[5:].split('/', 1)
+            self.names.setdefault(bucket, []).append(name)
+        for names in self.names.itervalues():
+            names.sort()
+        self.latency = latency
+        self.max_active = max_active
+        self.lock = threading.Lock()
+        self.active = 0
+        self.requests = 0
+        self.throttled = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d/storage/v1/b/' % self.server_address
+
+    def list(self, bucket, params):
+        prefix = params.get('prefix', '')
+        delimiter = params.get('delimiter')
+        entries = []  # (name, is_prefix), in order
+        for name in self.names.get(bucket, []):
+            if not name.startswith(prefix):
+                continue
+            end = name.find(delimiter, len(prefix)) if delimiter else -1
+            if end == -1:
+                entries.append((name, False))
+            elif not entries or entries[-1] != (name[:end + 1], True):
+                entries.append((name[:end + 1], True))
+        start = int(params.get('pageToken', 0))
+        page = entries[start:start + int(params.get('maxResults', self.PAGE_SIZE))]
+        resp = {'kind': 'storage#objects'}
+        if start + len(page) < len(entries):
+            resp['nextPageToken'] = str(start + len(page))
+        prefixes = [name for name, is_prefix in page if is_prefix]
+        items = [{'name': name} for name, is_prefix in page if not is_prefix]
+        if prefixes:
+            resp['prefixes'] = prefixes
+        if items:
+            resp['items'] = items
+        return resp
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
@@ -0,0 +1 @@
+../gubernator/junit_parser.py
\ No newline at end of file
@@ -0,0 +1,116 @@
+#!/usr/bin/env python2
+
+# Copyright 2017 The Kubernetes Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks junit_parser against parsing a whole ElementTree, as make_json used to.
+
+Run against real junit artifacts (the largest ones are the most interesting):
+
+    gsutil cp gs://kubernetes-jenkins/logs/<job>/<build>/artifacts/junit_*.xml /tmp/junit/
+    ./junit_parser_benchmark.py /tmp/junit/*.xml
+
+Without arguments, a synthetic junit file with --tests testcases is used. Each parse
+runs in its own process, so its peak memory can be measured.
+"""
+
+import argparse
+import hashlib
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import xml.etree.cElementTree as ET
+
+import junit_parser
+
+
+def parse_tree(xml):
+    """Parse a JUnit file as make_json did before junit_parser."""
+    tree = ET.fromstring(xml)
+    if tree.tag == 'testsuite':
+        suites = [('', tree)]
+    else:
+        suites = [(suite.attrib['name'] + ' ', suite) for suite in tree]
+    for prefix, suite in suites:
+        for child in suite.findall('testcase'):
+            yield (prefix + child.attrib['name'], float(child.attrib.get('time') or 0),
+                   [failure.text for failure in child.findall('failure')],
+                   child.find('skipped') is not None)
+
+
+def synthetic_junit(tests):
+    cases = []
+    for n in xrange(tests):
+        body = '<system-out>%s</system-out>' % ('log line %d\n' % n * 200)
+        if n % 50 == 0:
+            body += '<failure>%s</failure>' % ('stack frame\n' * 100)
+        cases.append('<testcase name="[k8s.io] Test %d" time="%d.5">%s</testcase>'
+                     % (n, n % 100, body))
+    return '<testsuite tests="%d">%s</testsuite>' % (tests, ''.join(cases))
+
+
+def run(parse, path):
+    """Return a digest of the parse's results, the time it took, and its peak memory in KB."""
+    with open(path) as f:
+        xml = f.read()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    digest = hashlib.sha1()
+    count = 0
+    for result in parse(xml):
+        digest.update(repr(result))
+        count += 1
+    elapsed = time.time() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    return (count, digest.hexdigest()), elapsed, peak_kb
+
+
+def measure(description, parse, path):
+    # a fresh process per parse, so peak memory from one doesn't hide the other's.
+    pool = multiprocessing.Pool(1)
+    try:
+        results, elapsed, peak_kb = pool.apply(run, (parse, path))
+    finally:
+        pool.terminate()
+    print '%-30s %8.3fs %8.1f MB peak (beyond input) %d tests' % (
+        description, elapsed, peak_kb / 1024.0, results[0])
+    return results
+
+
+def main(args):
+    paths = args.paths
+    if not paths:
+        path = '/tmp/junit_parser_benchmark.xml'
+        with open(path, 'w') as f:
+            f.write(synthetic_junit(args.tests))
+        paths = [path]
+    for path in paths:
+        print '== %s (%.1f MB)' % (path, os.path.getsize(path) / 1024.0 / 1024)
+        expected = measure('ElementTree.fromstring', parse_tree, path)
+        actual = measure('junit_parser.parse', junit_parser.parse, path)
+        assert expected == actual, 'results differ!'
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='*', help='JUnit XML files to parse')
+    parser.add_argument('--tests', type=int, default=20000,
+                        help='number of testcases in the synthetic junit file')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    main(parse_args(sys.argv[1:]))
@@ -24,32 +24,48 @@ import datetime
 import hashlib
 import logging
 import os
-import re
 import random
 import re
 import signal
 import sys
+import threading
 import time
 import urllib2
-from xml.etree import cElementTree as ET
+from xml.parsers import expat
 
 import multiprocessing
+import multiprocessing.pool
 import requests
+import requests.adapters
 import yaml
 
 import model
 
 
-def pad_numbers(s):
-    """Modify a string to make its numbers suitable for natural sorting."""
-    return re.sub(r'\d+', lambda m: m.group(0).rjust(16, '0'), s)
-
-
 class GCSClient(object):
+    API_URL = 'https://www.googleapis.com/storage/v1/b/'
+    # How many build numbers below a new job's newest build to look for late uploads in,
+    # and the most to look for in any job (see _pick_listed_builds).
+    MISSING_WINDOW = 40
+    MAX_MISSING = 1000
+    # Whether make_db's workers should be threads sharing one client (see PooledGCSClient),
+    # rather than processes with a client each.
+    THREADED = False
+
     def __init__(self, jobs_dir, metadata=None):
         self.jobs_dir = jobs_dir
         self.metadata = metadata or {}
-        self.session = requests.Session()
+        self.local = threading.local()
+
+    def _make_session(self):
+        return requests.Session()
+
+    def _get(self, url, params):
+        # Sessions aren't guaranteed to be thread-safe, so each thread gets its own.
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = self._make_session()
+        return session.get(url, params=params, stream=False)
 
     def _request(self, path, params, as_json=True):
         """GETs a JSON resource from GCS, with retries on failure.
@@ -58,10 +74,10 @@ class GCSClient(object):
         cloud.google.com/storage/docs/gsutil/addlhelp/RetryHandlingStrategy
 
         """
-        url = 'https://www.googleapis.com/storage/v1/b/%s' % path
+        url = self.API_URL + path
         for retry in xrange(23):
             try:
-                resp = self.session.get(url, params=params, stream=False)
+                resp = self._get(url, params)
                 if 400 <= resp.status_code < 500 and resp.status_code != 429:
                     return None
                 resp.raise_for_status()
@@ -146,41 +162,237 @@ class GCSClient(object):
         # Invalid latest-build or bucket is using timestamps
         build_paths = self.ls_dirs('%s%s/' % (self.jobs_dir, job))
         return True, sorted((os.path.basename(os.path.dirname(b))
-                            for b in build_paths), key=pad_numbers, reverse=True)
+                            for b in build_paths), key=model.pad_numbers, reverse=True)
 
     def get_started_finished(self, job, build):
         if self.metadata.get('pr'):
-            build_dir = self.get('%s/directory/%s/%s.txt' % (self.jobs_dir, job, build)).strip()
+            link = '%s/directory/%s/%s.txt' % (self.jobs_dir, job, build)
+            build_dir = self.get(link)
+            if build_dir is None:
+                # a missing number (see _pick_listed_builds) with no link yet
+                return link, None, None
+            build_dir = build_dir.strip()
         else:
             build_dir = '%s%s/%s' % (self.jobs_dir, job, build)
         started = self.get('%s/started.json' % build_dir, as_json=True)
         finished = self.get('%s/finished.json' % build_dir, as_json=True)
         return build_dir, started, finished
 
-    def get_builds(self, builds_have):
-        """Generates all (job, build) pairs ever."""
-        now = time.time()
+    def _get_new_builds(self, job, high_water, pending):
+        """Returns the builds of a job to fetch, newest first.
+
+        Args:
+            high_water: the newest build of the job seen before, or None.
+            pending: the job's builds that haven't finished (or appeared) yet.
+        """
+        precise, builds = self._get_builds(job)
+        if precise:
+            return self._pick_listed_builds(builds, high_water, pending)
+        new = []
+        mark = high_water and model.pad_numbers(high_water)
+        for build in builds:
+            if mark and model.pad_numbers(build) <= mark:
+                break
+            new.append(build)
+        # without a listing, there's no telling which pending builds have appeared
+        new.extend(sorted(pending.difference(new), key=model.pad_numbers, reverse=True))
+        return new
+
+    def _pick_listed_builds(self, listed, high_water, pending):
+        """Returns the builds to fetch from a listing of a job's builds, newest first.
+
+        These are the listed builds after high_water, and pending builds that are listed
+        now. Builds can be uploaded out of order, so numbers missing from the listing below
+        its newest build are returned too, if they aren't pending already: fetching them
+        finds nothing, which makes them pending until they appear. The numbers considered
+        are those after high_water, or for a job not seen before, those in the MISSING_WINDOW
+        below the newest build that aren't below the oldest listed one.
+        """
+        listed = set(listed)
+        mark = high_water and model.pad_numbers(high_water)
+        builds = {build for build in listed
+                  if build in pending or not mark or model.pad_numbers(build) > mark}
+        numbers = [int(build) for build in listed if build.isdigit()]
+        if numbers:
+            newest = max(numbers)
+            if high_water and high_water.isdigit():
+                first = int(high_water) + 1
+            else:
+                first = max(newest - self.MISSING_WINDOW, min(numbers))
+            # in case builds aren't numbered consecutively
+            first = max(first, newest - self.MAX_MISSING)
+            builds.update(str(n) for n in xrange(first, newest)
+                          if str(n) not in listed and str(n) not in pending)
+        return sorted(builds, key=model.pad_numbers, reverse=True)
+
+    def get_builds(self, high_water, pending, threads=1, progress=None):
+        """Generates the (job, build) pairs that might have changed since the last run.
+
+        These are each job's builds after its high water mark, and its pending builds (see
+        _pick_listed_builds). Jobs are scanned for new builds by a pool of threads, and each
+        job's builds are generated as soon as its scan is done, so fetching them can start
+        right away.
+
+        Args:
+            high_water: {job: newest build seen}
+            pending: {(job, build): since}, for builds seen before but not yet finished.
+        """
+        progress = progress or Progress()
+        pending_by_job = {}
+        for job, build in pending:
+            pending_by_job.setdefault(job, set()).add(build)
+
         if self.metadata.get('pr'):
+            listed = {}
             files = self.ls(self.jobs_dir + '/directory/', delim=False)
             for fname in files:
                 if fname.endswith('.txt') and 'latest-build' not in fname:
                     job, build = fname[:-4].split('/')[-2:]
-                    if (job, build) in builds_have:
-                        continue
+                    listed.setdefault(job, []).append(build)
+            for job, builds in sorted(listed.iteritems()):
+                builds = self._pick_listed_builds(
+                    builds, high_water.get(job), pending_by_job.get(job, set()))
+                progress.add('builds found', len(builds))
+                for build in builds:
+                    yield job, build
+            return
+
+        def list_jobs():
+            for job in self._get_jobs():
+                if job in ('pr-e2e-gce', 'maintenance-ci-testgrid-config-upload'):
+                    continue  # garbage.
+                progress.add('jobs listed')
+                yield job
+
+        def scan_job(job):
+            return job, self._get_new_builds(
+                job, high_water.get(job), pending_by_job.get(job, set()))
+
+        pool = None
+        if threads > 1:
+            pool = multiprocessing.pool.ThreadPool(threads)
+            scans = pool.imap_unordered(scan_job, list_jobs())
+        else:
+            scans = (scan_job(job) for job in list_jobs())
+        try:
+            for job, builds in scans:
+                progress.add('jobs scanned')
+                progress.add('builds found', len(builds))
+                for build in builds:
                     yield job, build
+        finally:
+            if pool:
+                pool.terminate()
+
+
+class Progress(object):
+    """Counts what each stage of make_db has done, to show where the time goes.
+
+    Stages may run in different threads, so counts are taken under a lock.
+    """
+    STAGES = ('jobs listed', 'jobs scanned', 'builds found', 'builds fetched',
+              'builds inserted')
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.counts = dict.fromkeys(self.STAGES, 0)
+        self.lock = threading.Lock()
+        self.start = self.last_report = time.time()
+
+    def add(self, stage, count=1):
+        with self.lock:
+            self.counts[stage] += count
+
+    def report(self, force=False):
+        """Print each stage's count and rate, at most every interval seconds unless forced."""
+        now = time.time()
+        if not force and now - self.last_report < self.interval:
             return
-        for job in self._get_jobs():
-            if job in ('pr-e2e-gce', 'maintenance-ci-testgrid-config-upload'):
-                continue  # garbage.
-            have = 0
-            precise, builds = self._get_builds(job)
-            for build in builds:
-                if (job, build) in builds_have:
-                    have += 1
-                    if have > 40 and not precise:
-                        break
-                    continue
-                yield job, build
+        self.last_report = now
+        elapsed = max(now - self.start, 1e-6)
+        with self.lock:
+            counts = dict(self.counts)
+        print('progress after %.1fs: %s' % (elapsed, ', '.join(
+            '%d %s (%.1f/s)' % (counts[stage], stage, counts[stage] / elapsed)
+            for stage in self.STAGES if counts[stage])))
+
+
+class AdaptiveLimiter(object):
+    """Limits how many requests are in flight, backing off when they are throttled.
+
+    The limit grows by one after each limit's worth of successful requests, and halves
+    when a request is throttled (additive increase, multiplicative decrease). Only one
+    decrease happens per round of requests, so a burst of 429s doesn't collapse the limit.
+    """
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = maximum
+        self.active = 0
+        self.successes = 0
+        self.epoch = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        """Wait for a free slot, and return a token to release it with."""
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+            return self.epoch
+
+    def release(self, epoch, throttled=False):
+        with self.cond:
+            self.active -= 1
+            if throttled:
+                if epoch == self.epoch:
+                    self.limit = max(self.minimum, self.limit // 2)
+                    self.successes = 0
+                    self.epoch += 1
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.maximum:
+                    self.limit += 1
+                    self.successes = 0
+            self.cond.notify_all()
+
+
+class PooledGCSClient(GCSClient):
+    """A GCSClient meant to be shared by many threads.
+
+    Requests reuse keep-alive connections from one pool, and an AdaptiveLimiter keeps
+    the number in flight under what GCS will serve without throttling.
+    """
+    THREADED = True
+    MAX_REQUESTS = 256
+
+    def __init__(self, jobs_dir, metadata=None):
+        super(PooledGCSClient, self).__init__(jobs_dir, metadata)
+        self.adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=self.MAX_REQUESTS)
+        self.limiter = AdaptiveLimiter(self.MAX_REQUESTS)
+
+    def _make_session(self):
+        # Each thread has its own session, but their connections come from one pool.
+        session = requests.Session()
+        session.mount('https://', self.adapter)
+        session.mount('http://', self.adapter)
+        return session
+
+    def _get(self, url, params):
+        epoch = self.limiter.acquire()
+        throttled = False
+        try:
+            resp = super(PooledGCSClient, self)._get(url, params)
+            throttled = resp.status_code == 429
+            return resp
+        finally:
+            self.limiter.release(epoch, throttled)
+
+
+DEFAULT_BATCH_SIZE = 200
+PENDING_TIMEOUT = 60 * 60 * 24 * 5  # seconds to keep checking unfinished builds for
 
 
 def mp_init_worker(jobs_dir, metadata, client_class):
@@ -194,45 +406,116 @@ def mp_init_worker(jobs_dir, metadata, client_class):
     global WORKER_CLIENT
     WORKER_CLIENT = client_class(jobs_dir, metadata)
 
+def make_pool(threads, jobs_dir, metadata, client_class, client=None):
+    """
+    Make a pool of workers that use WORKER_CLIENT.
+
+    Threaded clients are shared by a pool of threads, and others get a process each.
+    """
+    if client_class.THREADED:
+        global WORKER_CLIENT
+        WORKER_CLIENT = client or client_class(jobs_dir, metadata)
+        return multiprocessing.pool.ThreadPool(threads)
+    return multiprocessing.Pool(threads, mp_init_worker, (jobs_dir, metadata, client_class))
+
+
 def get_started_finished((job, build)):
     try:
-        return WORKER_CLIENT.get_started_finished(job, build)
+        return (job, build) + WORKER_CLIENT.get_started_finished(job, build)
     except:
         logging.exception('failed to get tests for %s/%s', job, build)
         raise
 
+START_TAG_RE = re.compile(r'<[^\s/>]+(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*(/?)>')
+
+
+def strip_system_out(data):
+    """
+    Remove system-out elements below the top level of a JUnit document.
+
+    They're bloated with logs nothing reads. The document is scanned with expat, without
+    building a tree, and the elements are cut out of the original text. Documents that
+    can't be parsed are returned unchanged.
+    """
+    if 'system-out' not in data:
+        return data
+    cuts = []  # (start, end) byte offsets of system-out elements
+    open_elements = []  # whether each open element is being cut out
+    parser = expat.ParserCreate()
+
+    def start_element(name, _attrs):
+        cutting = bool(open_elements) and open_elements[-1]
+        if not cutting and name == 'system-out' and len(open_elements) >= 2:
+            start = parser.CurrentByteIndex
+            tag = START_TAG_RE.match(data, start)
+            # an empty element ends with its start tag
+            cuts.append((start, tag.end() if tag and tag.group(1) else None))
+            open_elements.append(True)
+        else:
+            open_elements.append(cutting)
+
+    def end_element(_name):
+        cutting = open_elements.pop()
+        if cutting and not (open_elements and open_elements[-1]):
+            start, end = cuts[-1]
+            if end is None:
+                # expat reports the end at the start of the end tag
+                cuts[-1] = (start, data.index('>', parser.CurrentByteIndex) + 1)
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    try:
+        parser.Parse(data, True)
+    except expat.ExpatError:
+        return data
+    if not cuts:
+        return data
+    parts = []
+    last = 0
+    for start, end in cuts:
+        parts.append(data[last:start])
+        last = end
+    parts.append(data[last:])
+    return ''.join(parts)
+
+
 def get_junits((build_id, gcs_path)):
     try:
         junits = WORKER_CLIENT.get_junits_from_build(gcs_path)
+        # strip bloated system-out annotations here, so workers do the XML processing.
+        for path, data in junits.iteritems():
+            if data:
+                junits[path] = strip_system_out(data)
         return build_id, gcs_path, junits
     except:
         logging.exception('failed to get junits for %s', gcs_path)
         raise
 
 
-def get_builds(db, jobs_dir, metadata, threads, client_class):
+def get_builds(db, jobs_dir, metadata, threads, client_class, batch_size=DEFAULT_BATCH_SIZE):
     """
     Adds information about tests to a dictionary.
 
     Args:
         jobs_dir: the GCS path containing jobs.
         metadata: a dict of metadata about the jobs_dir.
-        threads: how many threads to use to download build information.
+        threads: how many threads to use to scan jobs, and to download build information.
         client_class: a constructor for a GCSClient (or a subclass).
+        batch_size: how many builds to insert (and commit) at once.
     """
     gcs = client_class(jobs_dir, metadata)
 
     print('Loading builds from %s' % jobs_dir)
 
-    builds_have = db.get_existing_builds(jobs_dir)
-    if builds_have:
-        print('already have %d builds' % len(builds_have))
+    high_water, pending = db.get_job_state(jobs_dir)
+    if high_water:
+        print('already seen %d jobs, with %d builds pending' % (len(high_water), len(pending)))
 
-    jobs_and_builds = gcs.get_builds(builds_have)
+    progress = Progress()
+    jobs_and_builds = gcs.get_builds(high_water, pending, threads, progress)
     pool = None
     if threads > 1:
-        pool = multiprocessing.Pool(threads, mp_init_worker,
-                                    (jobs_dir, metadata, client_class))
+        pool = make_pool(threads, jobs_dir, metadata, client_class, gcs)
         builds_iterator = pool.imap_unordered(
             get_started_finished, jobs_and_builds)
     else:
@@ -241,13 +524,33 @@ def get_builds(db, jobs_dir, metadata, threads, client_class):
         builds_iterator = (
             get_started_finished(job_build) for job_build in jobs_and_builds)
 
+    now = int(time.time())
+    newest = {}  # {job: newest build seen this run}
+    # Pending builds that aren't fetched (since they haven't appeared yet) stay pending.
+    new_pending = {job_build: since for job_build, since in pending.iteritems()
+                   if since >= now - PENDING_TIMEOUT}
+    batch = []
     try:
-        for n, (build_dir, started, finished) in enumerate(builds_iterator):
+        for job, build, build_dir, started, finished in builds_iterator:
             print(build_dir)
+            progress.add('builds fetched')
+            if job not in newest or model.pad_numbers(build) > model.pad_numbers(newest[job]):
+                newest[job] = build
+            new_pending.pop((job, build), None)
+            if not finished:
+                # Builds that haven't finished (or even started) are checked again next run,
+                # until they're too old to be expected to.
+                since = int(started['timestamp']) if started else pending.get((job, build), now)
+                if since >= now - PENDING_TIMEOUT:
+                    new_pending[job, build] = since
             if started or finished:
-                db.insert_build(build_dir, started, finished)
-            if n % 200 == 0:
+                batch.append((build_dir, started, finished))
+            if len(batch) >= batch_size:
+                db.insert_builds(batch)
                 db.commit()
+                progress.add('builds inserted', len(batch))
+                batch = []
+            progress.report()
     except KeyboardInterrupt:
         if pool:
             pool.terminate()
@@ -255,16 +558,22 @@ def get_builds(db, jobs_dir, metadata, threads, client_class):
     else:
         if pool:
             pool.close()
+    db.insert_builds(batch)
+    for job, build in newest.iteritems():
+        if job not in high_water or model.pad_numbers(build) > model.pad_numbers(high_water[job]):
+            high_water[job] = build
+    db.update_job_state(jobs_dir, high_water, new_pending)
     db.commit()
+    progress.add('builds inserted', len(batch))
+    progress.report(force=True)
 
 
-def download_junit(db, threads, client_class):
+def download_junit(db, threads, client_class, batch_size=DEFAULT_BATCH_SIZE):
     """Download junit results for builds without them."""
     builds_to_grab = db.get_builds_missing_junit()
     pool = None
     if threads > 1:
-        pool = multiprocessing.Pool(threads, mp_init_worker,
-                                    ('', {}, client_class))
+        pool = make_pool(threads, '', {}, client_class)
         test_iterator = pool.imap_unordered(
             get_junits, builds_to_grab)
     else:
@@ -272,37 +581,30 @@ def download_junit(db, threads, client_class):
         WORKER_CLIENT = client_class('', {})
         test_iterator = (
             get_junits(build_path) for build_path in builds_to_grab)
+    batch = []
     for n, (build_id, build_path, junits) in enumerate(test_iterator, 1):
         print('%d/%d' % (n, len(builds_to_grab)),
               build_path, len(junits), len(''.join(junits.values())))
-        # strip bloated system-out annotations
-        for path, data in junits.items():
-            if 'system-out' in data:
-                try:
-                    root = ET.fromstring(data)
-                    for parent in root.findall('*//system-out/..'):
-                        for child in parent.findall('system-out'):
-                            parent.remove(child)
-                    junits[path] = ET.tostring(root)
-                except ET.ParseError:
-                    continue
-
-        db.insert_build_junits(build_id, junits)
-        if n % 100 == 0:
+        batch.append((build_id, junits))
+        if len(batch) >= batch_size:
+            db.insert_builds_junits(batch)
             db.commit()
+            batch = []
+    db.insert_builds_junits(batch)
     db.commit()
 
 
-def main(db, jobs_dirs, threads, get_junit, client_class=GCSClient):
+def main(db, jobs_dirs, threads, get_junit, client_class=GCSClient,
+         batch_size=DEFAULT_BATCH_SIZE):
     """Collect test info in matching jobs."""
     get_builds(db, 'gs://kubernetes-jenkins/pr-logs', {'pr': True},
-               threads, client_class)
+               threads, client_class, batch_size)
     for bucket, metadata in jobs_dirs.iteritems():
         if not bucket.endswith('/'):
             bucket += '/'
-        get_builds(db, bucket, metadata, threads, client_class)
+        get_builds(db, bucket, metadata, threads, client_class, batch_size)
     if get_junit:
-        download_junit(db, threads, client_class)
+        download_junit(db, threads, client_class, batch_size)
 
 
 def get_options(argv):
@@ -324,11 +626,42 @@ def get_options(argv):
         action='store_true',
         help='Download JUnit results from each build'
     )
+    parser.add_argument(
+        '--pooled',
+        action='store_true',
+        help='Share one connection pool between threads, instead of using a process per thread'
+    )
+    parser.add_argument(
+        '--batch-size',
+        help='number of builds to write to the database in each transaction',
+        default=DEFAULT_BATCH_SIZE,
+        type=int,
+    )
+    parser.add_argument(
+        '--shards',
+        help='number of database files to split builds across',
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        '--codec',
+        help='how to compress new junit files',
+        default='zlib',
+        choices=sorted(model.DEFAULT_LEVELS),
+    )
+    parser.add_argument(
+        '--compression-level',
+        help='level to compress new junit files at (default depends on --codec)',
+        type=int,
+    )
     return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
     OPTIONS = get_options(sys.argv[1:])
     jobs_dirs = yaml.load(open(OPTIONS.buckets))
-    db = model.Database('build.db')
-    main(db, jobs_dirs, OPTIONS.threads, OPTIONS.junit)
+    db = model.open_database('build.db', OPTIONS.shards, OPTIONS.codec,
+                             OPTIONS.compression_level)
+    main(db, jobs_dirs, OPTIONS.threads, OPTIONS.junit,
+         PooledGCSClient if OPTIONS.pooled else GCSClient, OPTIONS.batch_size)
+    db.close()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python2
+
+# Copyright 2017 The Kubernetes Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks make_db's download throughput against a local fake of GCS.
+
+Each request is delayed by --latency, to stand in for the round trip to GCS, and
+requests past --max-active are throttled. A process per thread (GCSClient) is
+compared to threads sharing one connection pool (PooledGCSClient):
+
+    ./make_db_benchmark.py --jobs 20 --builds 100 --latency 0.05
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import fake_gcs
+import make_db
+import model
+
+
+JOBS_DIR = 'gs://kubernetes-jenkins/logs/'
+JUNIT = '''<testsuite>
+    <testcase name="Foo" time="3"/>
+    <testcase name="Bad" time="4"><failure>stacktrace</failure></testcase>
+</testsuite>'''
+
+
+class FakeGCSClient(make_db.GCSClient):
+    API_URL = None
+
+
+class FakePooledGCSClient(make_db.PooledGCSClient):
+    API_URL = None
+
+
+def make_objects(jobs, builds):
+    objects = {}
+    for job in xrange(jobs):
+        job_dir = '%sjob-%d/' % (JOBS_DIR, job)
+        objects[job_dir + 'latest-build.txt'] = str(builds)
+        for build in xrange(1, builds + 1):
+            build_dir = '%s%d/' % (job_dir, build)
+            objects[build_dir + 'started.json'] = {'timestamp': build * 1000}
+            objects[build_dir + 'finished.json'] = {'timestamp': build * 1000 + 600}
+            objects[build_dir + 'artifacts/junit_01.xml'] = JUNIT
+    return objects
+
+
+def run(server, threads, client_class):
+    db = model.Database(':memory:')
+    requests = server.requests
+    # the progress output would swamp the timings
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    start = time.time()
+    try:
+        make_db.main(db, {JOBS_DIR: {}}, threads, True, client_class)
+    finally:
+        sys.stdout = stdout
+    elapsed = time.time() - start
+    requests = server.requests - requests
+    print '%-40s %8.3fs %8.1f requests/s' % (
+        '%s, %d threads' % (client_class.__name__, threads), elapsed, requests / elapsed)
+    return sorted((path, started, finished, db.test_results_for_build(path))
+                  for _rowid, path, started, finished in db.get_builds())
+
+
+def main(args):
+    server = fake_gcs.FakeGCSServer(make_objects(args.jobs, args.builds),
+                                    args.latency, args.max_active)
+    server.start()
+    FakeGCSClient.API_URL = FakePooledGCSClient.API_URL = server.url
+    try:
+        expected = run(server, args.processes, FakeGCSClient)
+        for threads in args.threads:
+            assert run(server, threads, FakePooledGCSClient) == expected, 'results differ!'
+    finally:
+        server.stop()
+    print '%d requests throttled' % server.throttled
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=20, help='number of jobs to serve')
+    parser.add_argument('--builds', type=int, default=50, help='number of builds per job')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds to delay each request by')
+    parser.add_argument('--max-active', type=int, default=500,
+                        help='number of requests to serve at once before throttling')
+    parser.add_argument('--processes', type=int, default=32,
+                        help='number of processes to use with GCSClient')
+    parser.add_argument('--threads', type=int, nargs='+', default=[32, 128, 256],
+                        help='numbers of threads to use with PooledGCSClient')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    main(parse_args(sys.argv[1:]))
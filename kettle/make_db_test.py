@@ -22,6 +22,7 @@ import shutil
 import tempfile
 import unittest
 
+import fake_gcs
 import make_db
 import model
 
@@ -37,6 +38,7 @@ TEST_BUCKETS_DATA = {
 
 class MockedClient(make_db.GCSClient):
     """A GCSClient with stubs for external interactions."""
+    MISSING_WINDOW = 0
     NOW = int(time.time())
     LOG_DIR = 'gs://kubernetes-jenkins/logs/'
     JOB_DIR = LOG_DIR + 'fake/123/'
@@ -103,6 +105,44 @@ class GCSClientTest(unittest.TestCase):
         # fallback: still lists a directory when build-latest.txt isn't an int
         self.assertEqual((True, ['6']), self.client._get_builds('bad-latest'))
 
+    def test_get_builds_scans_jobs_concurrently(self):
+        self.client.lists = dict(MockedClient.lists)
+        self.client.lists[self.JOBS_DIR] = [self.JOBS_DIR + job + '/'
+                                            for job in ('fake', 'latest', 'bad-latest')]
+        # builds after each job's high water mark are found, as are pending builds
+        expected = [('bad-latest', '6'), ('fake', '122'), ('fake', '123'),
+                    ('latest', '1'), ('latest', '3'), ('latest', '4')]
+        for threads in [1, 4]:
+            progress = make_db.Progress()
+            self.assertEqual(expected, sorted(self.client.get_builds(
+                {'latest': '2', 'fake': '121', 'bad-latest': '5'},
+                {('fake', '122'): 0, ('latest', '1'): 0}, threads, progress)))
+            self.assertEqual(progress.counts['jobs listed'], 3)
+            self.assertEqual(progress.counts['jobs scanned'], 3)
+            self.assertEqual(progress.counts['builds found'], 6)
+
+    def test_get_builds_missing(self):
+        # builds can be uploaded out of order, so missing numbers are looked for
+        self.client.lists = {self.JOBS_DIR + 'fake/': [
+            self.JOBS_DIR + 'fake/%d/' % n for n in (10, 13, 15)]}
+        self.client.metadata = {'sequential': False}
+        self.assertEqual(self.client._get_new_builds('fake', '11', set()),
+                         ['15', '14', '13', '12'])
+        # pending builds are only fetched once they're listed
+        self.assertEqual(self.client._get_new_builds('fake', '15', {'10', '14'}), ['10'])
+        self.client.MISSING_WINDOW = 3
+        self.assertEqual(self.client._get_new_builds('fake', None, set()),
+                         ['15', '14', '13', '12', '10'])
+
+    def test_get_builds_pr(self):
+        self.client.jobs_dir = 'gs://kubernetes-jenkins/pr-logs'
+        self.client.metadata = {'pr': True}
+        self.client.lists = {self.client.jobs_dir + '/directory/': [
+            self.client.jobs_dir + '/directory/%s.txt' % path
+            for path in ('job/latest-build', 'job/5', 'job/7', 'other/2')]}
+        self.assertEqual(list(self.client.get_builds({'job': '5'}, {('other', '2'): 0})),
+                         [('job', '7'), ('job', '6'), ('other', '2')])
+
     def test_get_builds_non_sequential(self):
         # fallback: setting sequential=false causes directory listing
         self.client.metadata = {'sequential': False}
@@ -110,6 +150,39 @@ class GCSClientTest(unittest.TestCase):
                          self.client._get_builds('latest'))
 
 
+class StripSystemOutTest(unittest.TestCase):
+    def test_strip(self):
+        data = (
+            '<?xml version="1.0"?>\n'
+            '<testsuites>\n'
+            '  <testsuite name="a">\n'
+            '    <testcase name="Foo" time="3"><system-out>lots of\nlogs &amp; <b/></system-out>'
+            '</testcase>\n'
+            '    <testcase name="Bar"><system-out/><failure>bad</failure></testcase>\n'
+            '    <testcase name="Baz"><system-out a="/>"/><system-out>a/></system-out></testcase>\n'
+            '    <system-out>suite logs</system-out >\n'
+            '  </testsuite>\n'
+            '  <system-out>kept, since it is not in a testsuite</system-out>\n'
+            '</testsuites>')
+        self.assertEqual(make_db.strip_system_out(data), (
+            '<?xml version="1.0"?>\n'
+            '<testsuites>\n'
+            '  <testsuite name="a">\n'
+            '    <testcase name="Foo" time="3"></testcase>\n'
+            '    <testcase name="Bar"><failure>bad</failure></testcase>\n'
+            '    <testcase name="Baz"></testcase>\n'
+            '    \n'
+            '  </testsuite>\n'
+            '  <system-out>kept, since it is not in a testsuite</system-out>\n'
+            '</testsuites>'))
+
+    def test_unchanged(self):
+        for data in ['<testsuite><testcase name="Foo"/></testsuite>',
+                     '<testsuite><system-out>top level</system-out></testsuite>',
+                     '<testsuite><testcase><system-out>malformed</testcase></testsuite>']:
+            self.assertEqual(make_db.strip_system_out(data), data)
+
+
 class MainTest(unittest.TestCase):
     """End-to-end test of the main function's output."""
     JOBS_DIR = GCSClientTest.JOBS_DIR
@@ -173,6 +246,126 @@ class MainTest(unittest.TestCase):
 
         self.assert_main_output(1, expected, db, MockedClientNewer)
 
+    def test_incremental_pending(self):
+        class MockedClientRunning(MockedClient):
+            LOG_DIR = MockedClient.LOG_DIR
+            lists = dict(MockedClient.lists)
+            lists[LOG_DIR + 'fake/'] = [LOG_DIR + 'fake/124/', MockedClient.JOB_DIR]
+            gets = dict(MockedClient.gets)
+            del gets[MockedClient.JOB_DIR + 'finished.json']
+            gets[MockedClient.JOB_DIR + 'started.json'] = {'timestamp': MockedClient.NOW}
+
+        db = model.Database(':memory:')
+        make_db.main(db, {self.JOBS_DIR: {}}, 1, True, MockedClientRunning)
+        high_water, pending = db.get_job_state(self.JOBS_DIR)
+        self.assertEqual(high_water, {'fake': '124'})
+        # 124 hasn't even started, and is checked again from when it was first seen
+        self.assertEqual(sorted(pending), [('fake', '123'), ('fake', '124')])
+        self.assertEqual(pending['fake', '123'], MockedClient.NOW)
+
+        # 123 is fetched again now that it's finished, but 122 is below the high water mark
+        expected = self.get_expected_builds()
+        del expected[MockedClient.JOB_DIR.replace('123', '122')[:-1]]
+        self.assert_main_output(1, expected, db, MockedClient)
+        high_water, pending = db.get_job_state(self.JOBS_DIR)
+        self.assertEqual((high_water, sorted(pending)), ({'fake': '124'}, [('fake', '124')]))
+
+    def test_pr_missing(self):
+        pr_dir = 'gs://kubernetes-jenkins/pr-logs/'
+        build_dir = pr_dir + 'pull/1/job/5'
+
+        class MockedClientPR(MockedClient):
+            MISSING_WINDOW = 40
+            lists = dict(MockedClient.lists)
+            lists[pr_dir + 'directory/'] = [
+                pr_dir + 'directory/job/%s.txt' % n for n in ('latest-build', 5, 7)]
+            lists[build_dir + '/artifacts/'] = []
+            gets = dict(MockedClient.gets)
+            gets[pr_dir + 'directory/job/5.txt'] = build_dir + '\n'
+            gets[build_dir + '/finished.json'] = {'timestamp': 125}
+
+        expected = self.get_expected_builds()
+        expected[build_dir] = (None, {'timestamp': 125}, [])
+        db = self.assert_main_output(1, expected, client=MockedClientPR)
+        # 6 has no link and 7's link is unreadable, so both are checked again later
+        self.assertEqual(sorted(db.get_job_state(pr_dir[:-1])[1]),
+                         [('job', '6'), ('job', '7')])
+
+    def test_incremental_out_of_order(self):
+        def make_client(builds):
+            build_dirs = [MockedClient.LOG_DIR + 'fake/%d/' % n for n in builds]
+
+            class MockedClientBuilds(MockedClient):
+                lists = dict(MockedClient.lists)
+                lists[MockedClient.LOG_DIR + 'fake/'] = build_dirs
+                gets = {path: data for path, data in MockedClient.gets.iteritems()
+                        if '/fake/' not in path or path.startswith(tuple(build_dirs))}
+            return MockedClientBuilds
+
+        expected = self.get_expected_builds()
+        db = model.Database(':memory:')
+        self.assert_main_output(1, {}, db, make_client([121]))
+        # 122 is uploaded after 123, so it's missing from this listing
+        del expected[MockedClient.JOB_DIR.replace('123', '122')[:-1]]
+        self.assert_main_output(1, expected, db, make_client([123, 121]))
+        self.assertIn(('fake', '122'), db.get_job_state(self.JOBS_DIR)[1])
+        # and is fetched once it appears
+        self.assert_main_output(1, None, db, make_client([123, 122, 121]))
+        self.assertNotIn(('fake', '122'), db.get_job_state(self.JOBS_DIR)[1])
+
+class AdaptiveLimiterTest(unittest.TestCase):
+    def test_backoff(self):
+        limiter = make_db.AdaptiveLimiter(8)
+        tokens = [limiter.acquire() for _ in range(8)]
+        self.assertEqual(limiter.active, 8)
+        for token in tokens:
+            limiter.release(token, throttled=True)
+        # a round of throttled requests only halves the limit once
+        self.assertEqual((limiter.limit, limiter.active), (4, 0))
+        for _ in range(4):
+            limiter.release(limiter.acquire())
+        self.assertEqual(limiter.limit, 5)
+        for _ in range(5):
+            limiter.release(limiter.acquire(), throttled=True)
+        self.assertEqual(limiter.limit, 1)
+
+
+class FakeServerClient(make_db.PooledGCSClient):
+    """A PooledGCSClient for a FakeGCSServer."""
+    API_URL = None
+    MISSING_WINDOW = 0
+
+
+class PooledGCSClientTest(unittest.TestCase):
+    """Tests for PooledGCSClient, against a local fake of GCS."""
+    JOBS_DIR = GCSClientTest.JOBS_DIR
+
+    def start_server(self, **kwargs):
+        objects = {path: data for path, data in MockedClient.gets.iteritems()
+                   if path.startswith(MockedClient.LOG_DIR + 'fake/')}
+        server = fake_gcs.FakeGCSServer(objects, **kwargs)
+        server.start()
+        self.addCleanup(server.stop)
+        FakeServerClient.API_URL = server.url
+        return server
+
+    def assert_main_output(self, threads):
+        db = model.Database(':memory:')
+        make_db.main(db, {self.JOBS_DIR: {}}, threads, True, FakeServerClient)
+        result = {path: (started, finished, db.test_results_for_build(path))
+                  for _rowid, path, started, finished in db.get_builds()}
+        self.assertEqual(result, MainTest('test_clean').get_expected_builds())
+
+    def test_main(self):
+        self.start_server()
+        for threads in [1, 8]:
+            self.assert_main_output(threads)
+
+    def test_main_throttled(self):
+        # throttled requests are retried
+        self.start_server(latency=0.01, max_active=2)
+        self.assert_main_output(8)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -15,68 +15,37 @@
 # limitations under the License.
 
 import argparse
+import collections
 import hashlib
+import itertools
 import logging
 import json
+import multiprocessing
 import os
 import sqlite3
 import subprocess
 import sys
 import time
 
-try:
-    import defusedxml.ElementTree as ET
-except ImportError:
-    import xml.etree.cElementTree as ET
-
+import junit_parser
 import model
 
 
 def parse_junit(xml):
     """Generate failed tests as a series of dicts. Ignore skipped tests."""
-    # NOTE: this is modified from gubernator/view_build.py
-    tree = ET.fromstring(xml)
-
-    def make_result(name, time, failure_text, skipped):
+    # NOTE: junit_parser is shared with gubernator/view_build.py
+    def make_result(name, time, failure_text):
         if failure_text:
-            if time is None:
-                return {'name': name, 'failed': True, 'failure_text': failure_text}
-            else:
-                return {'name': name, 'time': time, 'failed': True, 'failure_text': failure_text}
+            return {'name': name, 'time': time, 'failed': True, 'failure_text': failure_text}
         else:
-            if time is None:
-                return {'name': name}
-            else:
-                return {'name': name, 'time': time}
+            return {'name': name, 'time': time}
 
     # Note: skipped tests are ignored because they make rows too large for BigQuery.
     # Knowing that a given build could have ran a test but didn't for some reason isn't very interesting.
-    if tree.tag == 'testsuite':
-        for child in tree:
-            name = child.attrib['name']
-            time = float(child.attrib['time'] or 0)
-            failure_text = None
-            for param in child.findall('failure'):
-                failure_text = param.text
-            skipped = child.findall('skipped')
-            if skipped:
-                continue
-            yield make_result(name, time, failure_text, skipped)
-    elif tree.tag == 'testsuites':
-        for testsuite in tree:
-            suite_name = testsuite.attrib['name']
-            for child in testsuite.findall('testcase'):
-                name = '%s %s' % (suite_name, child.attrib['name'])
-                time = float(child.attrib['time'] or 0)
-                failure_text = None
-                for param in child.findall('failure'):
-                    failure_text = param.text
-                skipped = child.findall('skipped')
-                if skipped:
-                    continue
-                yield make_result(name, time, failure_text, skipped)
-    else:
-        logging.error('unable to find failures, unexpected tag %s', tree.tag)
+    for name, time, failure_texts, skipped in junit_parser.parse(xml):
+        if skipped:
+            continue
+        yield make_result(name, time, failure_texts[-1] if failure_texts else None)
 
 
 # pypy compatibility hack
@@ -162,6 +131,64 @@ def row_for_build(path, started, finished, results):
     return build
 
 
+def make_rows(builds):
+    """Return (rowid, JSON row) for each (rowid, path, started, finished, results) build.
+
+    Builds that can't be made into rows are logged and skipped.
+    """
+    rows = []
+    for rowid, path, started, finished, results in builds:
+        try:
+            row = row_for_build(path, started, finished, results)
+            rows.append((rowid, json.dumps(row, sort_keys=True)))
+        except:
+            logging.exception('error on %s', path)
+    return rows
+
+
+def get_build_batches(db, builds, batch_size):
+    """Generate lists of up to batch_size builds, each with its junit results.
+
+    Builds whose results can't be read are logged and skipped.
+    """
+    while True:
+        chunk = list(itertools.islice(builds, batch_size))
+        if not chunk:
+            return
+        batch = []
+        for rowid, path, started, finished in chunk:
+            try:
+                results = db.test_results_for_build(path)
+            except:
+                logging.exception('error on %s', path)
+                continue
+            batch.append((rowid, path, started, finished, results))
+        yield batch
+
+
+def map_ordered(func, iterable, processes):
+    """
+    Like itertools.imap, with func run by a pool of processes if there's more than one.
+
+    Unlike Pool.imap, only a few items per process are read ahead of the results.
+    """
+    if processes <= 1:
+        for result in itertools.imap(func, iterable):
+            yield result
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = collections.deque()
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
 def parse_args(args):
     parser = argparse.ArgumentParser()
     parser.add_argument('--day', action='store_true',
@@ -170,6 +197,12 @@ def parse_args(args):
                         help='Grab data for builds within N days')
     parser.add_argument('--reset-emitted', action='store_true',
                         help='Clear list of already-emitted builds.')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Number of database files builds are split across.')
+    parser.add_argument('--parallelism', type=int, default=1,
+                        help='Number of processes to parse junit and serialize rows with.')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='Number of builds to hand to a process at once.')
     return parser.parse_args(args)
 
 def main(db, opts, outfile):
@@ -184,19 +217,18 @@ def main(db, opts, outfile):
         db.reset_emitted(incremental_table)
 
     builds = db.get_builds(min_started=min_started, incremental_table=incremental_table)
+    batches = get_build_batches(db, builds, opts.batch_size)
 
     rows_emitted = set()
-    for rowid, path, started, finished in builds:
-        try:
-            results = db.test_results_for_build(path)
-            row = row_for_build(path, started, finished, results)
-            json.dump(row, outfile, sort_keys=True)
-            outfile.write('\n')
-            rows_emitted.add(rowid)
-        except IOError:
-            return
-        except:
-            logging.exception('error on %s', path)
+    try:
+        # rows are written in the order builds finished, as they're read from the database.
+        for rows in map_ordered(make_rows, batches, opts.parallelism):
+            for rowid, row in rows:
+                outfile.write(row)
+                outfile.write('\n')
+                rows_emitted.add(rowid)
+    except IOError:
+        return
 
     if rows_emitted:
         gen = db.insert_emitted(rows_emitted, incremental_table=incremental_table)
@@ -206,6 +238,7 @@ def main(db, opts, outfile):
 
 
 if __name__ == '__main__':
-    db = model.Database('build.db')
     opts = parse_args(sys.argv[1:])
+    db = model.open_database('build.db', opts.shards)
     main(db, opts, sys.stdout)
+    db.close()
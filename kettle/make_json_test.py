@@ -74,6 +74,12 @@ class MakeJsonTest(unittest.TestCase):
             test=[{'name': 't1', 'time': 1.0, 'failed': True, 'failure_text': 'stacktrace'}, {'name': 't2', 'time': 2.0}])
 
     def test_main(self):
+        self.check_main([])
+
+    def test_main_parallel(self):
+        self.check_main(['--parallelism', '2', '--batch-size', '1'])
+
+    def check_main(self, extra_args):
         now = time.time()
         last_month = now - (60 * 60 * 24 * 30)
         junits = ['<testsuite><testcase name="t1" time="3.0"></testcase></testsuite>']
@@ -86,7 +92,7 @@ class MakeJsonTest(unittest.TestCase):
 
         def expect(args, needles, negneedles):
             buf = StringIO.StringIO()
-            opts = make_json.parse_args(args)
+            opts = make_json.parse_args(args + extra_args)
             make_json.main(self.db, opts, buf)
             result = buf.getvalue()
 
@@ -117,6 +123,31 @@ class MakeJsonTest(unittest.TestCase):
         expect(['--day', '--reset-emitted'], ['456', '457'], [])  # both (reset)
         expect([], [], ['123', '456', '457'])                     # reset only works for given day
 
+    def test_main_order(self):
+        for n in range(20):
+            path = 'gs://kubernetes-jenkins/logs/some-job/%d' % n
+            # insert builds out of the order they finished in
+            self.db.insert_build(path, {'timestamp': 1000}, {'timestamp': 1000 + (n * 7) % 20,
+                                                             'result': 'SUCCESS'})
+        for extra_args in [[], ['--parallelism', '3', '--batch-size', '2']]:
+            buf = StringIO.StringIO()
+            make_json.main(self.db, make_json.parse_args(['--reset-emitted'] + extra_args), buf)
+            finished = [json.loads(line)['finished'] for line in buf.getvalue().splitlines()]
+            self.assertEqual(finished, range(1000, 1020))
+
+
+    def test_get_build_batches_skips_errors(self):
+        class BrokenDatabase(object):
+            def test_results_for_build(self, path):
+                if path.endswith('/2'):
+                    raise ValueError('bad results')
+                return [path]
+
+        builds = iter([(n, 'job/%d' % n, None, None) for n in range(4)])
+        batches = list(make_json.get_build_batches(BrokenDatabase(), builds, 2))
+        self.assertEqual([[rowid for rowid, _, _, _, _ in batch] for batch in batches],
+                         [[0, 1], [3]])
+
 
 if __name__ == '__main__':
     unittest.main()
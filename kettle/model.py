@@ -14,10 +14,78 @@
 
 
 
+import collections
+import hashlib
+import heapq
 import json
+import os
+import re
 import zlib
 import sqlite3
 import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+
+# Schema changes, applied in order to bring a database up to date. The number of
+# migrations applied is tracked in the database's user_version.
+MIGRATIONS = [
+    '''
+    create table if not exists build(gcs_path primary key, started_json, finished_json, finished_time);
+    create table if not exists file(path string primary key, data);
+    create table if not exists build_junit_grabbed(build_id integer primary key);
+    ''',
+    # make_json selects and orders builds to emit by finished_time, and make_db lists
+    # the builds under a bucket, and whether they're finished, from a covering index.
+    '''
+    create index if not exists build_finished_time on build(finished_time);
+    create index if not exists build_path_finished on build(gcs_path, finished_json is null);
+    ''',
+    # junit files are stored once per distinct content, keyed by its sha1. The file table
+    # is still read, for files written before this.
+    '''
+    create table if not exists junit_blob(hash blob primary key, codec text, data blob);
+    create table if not exists junit_file(path text primary key, hash blob);
+    create table if not exists compression_dict(id integer primary key, codec text, data blob);
+    ''',
+    # make_db's discovery state: the newest build looked for in each job, and the builds
+    # that may still change.
+    '''
+    create table if not exists job_state(jobs_dir text, job text, high_water text,
+                                         primary key(jobs_dir, job));
+    create table if not exists pending_build(jobs_dir text, job text, build text, since integer,
+                                             primary key(jobs_dir, job, build));
+    ''',
+    # make_db no longer lists the builds under a bucket.
+    '''
+    drop index if exists build_path_finished;
+    ''',
+]
+
+# Compression levels to use when none is given.
+DEFAULT_LEVELS = {'zlib': 6, 'zstd': 3, 'zstd-dict': 3}
+
+
+def pad_numbers(s):
+    """Modify a string to make its numbers suitable for natural sorting."""
+    return re.sub(r'\d+', lambda m: m.group(0).rjust(16, '0'), s)
+
+
+def prefix_range(column, prefix):
+    """
+    Return a condition (and its parameters) for column starting with prefix.
+
+    Unlike LIKE, which is case-insensitive and treats _ as a wildcard, this can be
+    answered with an index on the column.
+    """
+    if not prefix:
+        return '1', ()
+    return ('%s >= ? and %s < ?' % (column, column),
+            (prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)))
 
 
 class Database(object):
@@ -26,44 +94,103 @@ class Database(object):
     """
 
     DEFAULT_INCREMENTAL_TABLE = 'build_emitted'
+    MAX_VARIABLES = 500  # per query; SQLite allows 999 by default.
+    DICT_SIZE = 112640  # bytes, for trained zstd dictionaries
+    DICT_SAMPLES = 2000  # junit files to train them on
+    DICT_RETRY_BLOBS = 1000  # new junit files to store before training again, if it failed
 
-    def __init__(self, path):
-        self.db = sqlite3.connect(path)
-        self.db.executescript('''
-            create table if not exists build(gcs_path primary key, started_json, finished_json, finished_time);
-            create table if not exists file(path string primary key, data);
-            create table if not exists build_junit_grabbed(build_id integer primary key);
-            ''')
+    def __init__(self, path, codec='zlib', level=None):
+        """
+        Open (and migrate) the database at path.
+
+        New junit files are compressed with codec at the given level. The codecs are zlib,
+        zstd, and zstd-dict: zstd with a dictionary trained on the junit files already in
+        the database. zstd needs the zstandard module. Files are readable whatever codec
+        they were written with.
+        """
+        if codec not in DEFAULT_LEVELS:
+            raise ValueError('unknown codec %r' % codec)
+        if codec.startswith('zstd') and zstd is None:
+            raise ValueError('the %s codec needs the zstandard module' % codec)
+        # ShardedDatabase uses each shard from its own thread, one at a time.
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # Larger pages suit the big compressed junit blobs (this only affects new databases),
+        # and the write-ahead log lets make_json read while make_db is writing.
+        self.db.execute('pragma page_size = 16384')
+        self.db.execute('pragma journal_mode = wal')
+        self.db.execute('pragma synchronous = normal')
+        self.db.execute('pragma cache_size = -262144')  # KiB, so 256MiB
+        self.migrate()
+        self.codec = codec
+        self.level = level or DEFAULT_LEVELS[codec]
+        self.compressor = None  # (codec name to store, function), made on first use
+        self.untrained_blobs = None  # files stored with plain zstd, while zstd-dict has none
+        self.decompressors = {'zlib': zlib.decompress}
+
+    def migrate(self):
+        """Apply any MIGRATIONS that haven't been applied yet."""
+        version, = self.db.execute('pragma user_version').fetchone()
+        for version, script in enumerate(MIGRATIONS[version:], version + 1):
+            self.db.executescript(script)
+            self.db.execute('pragma user_version = %d' % version)
+        self.db.commit()
 
     def commit(self):
         self.db.commit()
 
-    def get_existing_builds(self, jobs_dir):
+    def close(self):
+        self.db.close()
+
+    def get_job_state(self, jobs_dir):
         """
-        Return a set of (job, number) tuples indicating already present builds.
+        Return ({job: high water}, {(job, build): since}) for the jobs under jobs_dir.
+
+        A job's high water mark is the newest build make_db has looked for in it. Older
+        builds are only looked for again if they're pending: started but not finished, or
+        not started yet. since is when they started, or were first looked for.
 
-        A build is already present if it has a finished.json, or if it's older than
-        five days with no finished.json.
+        The first time a jobs_dir is used, its state is worked out from the stored builds.
         """
-        jobs_like = jobs_dir + '%'
-        builds_have_paths = self.db.execute(
-            'select gcs_path from build'
-            ' where gcs_path LIKE ?'
-            ' and finished_json IS NOT NULL'
-            ,
-            (jobs_dir + '%',)).fetchall()
+        state = self._get_stored_job_state(jobs_dir)
+        if state is None:
+            state = self._job_state_from_builds(jobs_dir)
+            self.update_job_state(jobs_dir, *state)
+        return state
+
+    def _get_stored_job_state(self, jobs_dir):
+        """Return the job state stored for jobs_dir, or None if there isn't any yet."""
+        high_water = dict(self.db.execute(
+            'select job, high_water from job_state where jobs_dir = ?', (jobs_dir,)))
+        if not high_water:
+            return None
+        pending = {(job, build): since for job, build, since in self.db.execute(
+            'select job, build, since from pending_build where jobs_dir = ?', (jobs_dir,))}
+        return high_water, pending
+
+    def _job_state_from_builds(self, jobs_dir):
         path_tuple = lambda path: tuple(path[len(jobs_dir):].split('/')[-2:])
-        builds_have = {path_tuple(path) for (path,) in builds_have_paths}
+        high_water = {}
+        pending = {}
+        condition, params = prefix_range('gcs_path', jobs_dir)
         for path, started_json in self.db.execute(
-                'select gcs_path, started_json from build'
-                ' where gcs_path LIKE ?'
-                ' and started_json IS NOT NULL and finished_json IS NULL',
-                (jobs_dir + '%',)):
-            started = json.loads(started_json)
-            if int(started['timestamp']) < time.time() - 60*60*24*5:
-                # over 5 days old, no need to try looking for finished any more.
-                builds_have.add(path_tuple(path))
-        return builds_have
+                'select gcs_path, case when finished_json is null then started_json end'
+                ' from build where %s' % condition, params):
+            job, build = path_tuple(path)
+            if job not in high_water or pad_numbers(build) > pad_numbers(high_water[job]):
+                high_water[job] = build
+            if started_json:
+                started = int(json.loads(started_json)['timestamp'])
+                if started >= time.time() - 60*60*24*5:
+                    pending[job, build] = started
+        return high_water, pending
+
+    def update_job_state(self, jobs_dir, high_water, pending):
+        """Replace the high water marks of the given jobs, and all pending builds."""
+        self.db.executemany('replace into job_state values(?,?,?)', (
+            (jobs_dir, job, build) for job, build in high_water.iteritems()))
+        self.db.execute('delete from pending_build where jobs_dir = ?', (jobs_dir,))
+        self.db.executemany('insert into pending_build values(?,?,?,?)', (
+            (jobs_dir, job, build, since) for (job, build), since in pending.iteritems()))
 
     ### make_db
 
@@ -71,32 +198,151 @@ class Database(object):
         """
         Add a build with optional started and finished dictionaries to the database.
         """
-        started_json = started and json.dumps(started, sort_keys=True)
-        finished_json = finished and json.dumps(finished, sort_keys=True)
-        if not self.db.execute('select 1 from build where gcs_path=? '
-                'and started_json=? and finished_json=?',
-                (build_dir, started_json, finished_json)).fetchone():
-            self.db.execute('replace into build values(?,?,?,?)',
-                 (build_dir, started_json, finished_json,
-                  finished and finished.get('timestamp', None)))
+        self.insert_builds([(build_dir, started, finished)])
+
+    def insert_builds(self, builds):
+        """
+        Add a list of (build_dir, started, finished) builds to the database.
+
+        Builds already stored with the same started and finished are left alone. They're
+        found with one query per chunk of builds, and the rest are written with one
+        executemany, in the caller's transaction.
+        """
+        # the last of any duplicates wins, as with separate inserts
+        rows = collections.OrderedDict()
+        for build_dir, started, finished in builds:
+            rows[build_dir] = (build_dir,
+                               started and json.dumps(started, sort_keys=True),
+                               finished and json.dumps(finished, sort_keys=True),
+                               finished and finished.get('timestamp', None))
+        existing = set()
+        paths = list(rows)
+        for n in xrange(0, len(paths), self.MAX_VARIABLES):
+            chunk = paths[n:n + self.MAX_VARIABLES]
+            existing.update(self.db.execute(
+                'select gcs_path, started_json, finished_json from build'
+                ' where gcs_path in (%s)' % ','.join('?' * len(chunk)), chunk))
+        # NULLs never compare equal in SQL, so builds without started or finished are
+        # always replaced.
+        self.db.executemany('replace into build values(?,?,?,?)', [
+            row for row in rows.itervalues()
+            if None in row[1:3] or row[:3] not in existing])
 
     def get_builds_missing_junit(self):
         """
         Return (rowid, path) for each build that hasn't enumerated junit files.
         """
         return self.db.execute(
-            'select rowid, gcs_path from build'
-            ' where rowid not in (select build_id from build_junit_grabbed)'
+            'select build.rowid, gcs_path from build'
+            ' left join build_junit_grabbed on build_id = build.rowid'
+            ' where build_id is null'
         ).fetchall()
 
     def insert_build_junits(self, build_id, junits):
         """
         Insert a junit dictionary {gcs_path: contents} for a given build's rowid.
         """
-        for path, data in junits.iteritems():
-            self.db.execute('replace into file values(?,?)',
-                            (path, buffer(zlib.compress(data, 9))))
-        self.db.execute('insert into build_junit_grabbed values(?)', (build_id,))
+        self.insert_builds_junits([(build_id, junits)])
+
+    def insert_builds_junits(self, builds_junits):
+        """
+        Insert a list of (build_id, {gcs_path: contents}) junits, as insert_build_junits.
+
+        Contents are stored once however many files have them, and only contents that
+        aren't already stored are compressed.
+        """
+        files = {}  # {path: hash}
+        blobs = {}  # {hash: data}
+        for _, junits in builds_junits:
+            for path, data in junits.iteritems():
+                digest = hashlib.sha1(data).digest()
+                files[path] = buffer(digest)
+                blobs[digest] = data
+        hashes = [buffer(digest) for digest in blobs]
+        for n in xrange(0, len(hashes), self.MAX_VARIABLES):
+            chunk = hashes[n:n + self.MAX_VARIABLES]
+            for digest, in self.db.execute(
+                    'select hash from junit_blob where hash in (%s)'
+                    % ','.join('?' * len(chunk)), chunk):
+                del blobs[str(digest)]
+        if blobs:
+            codec, compress = self._get_compressor(len(blobs))
+            self.db.executemany('insert into junit_blob values(?,?,?)', [
+                (buffer(digest), codec, buffer(compress(data)))
+                for digest, data in blobs.iteritems()])
+        self.db.executemany('replace into junit_file values(?,?)', files.iteritems())
+        # files written before junit_blob existed are superseded
+        self.db.executemany('delete from file where path = ?', ((path,) for path in files))
+        self.db.executemany('insert into build_junit_grabbed values(?)',
+                            [(build_id,) for build_id, _ in builds_junits])
+
+    def _get_compressor(self, count):
+        """Return the codec to record for count new junit blobs, and a function to compress them."""
+        if self.untrained_blobs is not None:
+            if self.untrained_blobs >= self.DICT_RETRY_BLOBS:
+                self.compressor = self.untrained_blobs = None
+            else:
+                self.untrained_blobs += count
+        if self.compressor:
+            return self.compressor
+        if self.codec == 'zlib':
+            level = self.level
+            self.compressor = 'zlib', lambda data: zlib.compress(data, level)
+        elif self.codec == 'zstd':
+            self.compressor = 'zstd', zstd.ZstdCompressor(level=self.level).compress
+        else:
+            dict_id, dict_data = self._get_zstd_dict()
+            if dict_id is None:
+                # Too little to train a dictionary on yet. Sampling the stored files is slow,
+                # so plain zstd is used until DICT_RETRY_BLOBS more have been stored.
+                self.untrained_blobs = count
+                self.compressor = 'zstd', zstd.ZstdCompressor(level=self.level).compress
+                return self.compressor
+            self.compressor = 'zstd:%d' % dict_id, zstd.ZstdCompressor(
+                level=self.level, dict_data=zstd.ZstdCompressionDict(dict_data)).compress
+        return self.compressor
+
+    def _get_zstd_dict(self):
+        """
+        Return the (id, data) of the newest zstd dictionary, training one if there are none.
+
+        Returns (None, None) if there are too few junit files stored to train one.
+        """
+        row = self.db.execute("select id, data from compression_dict where codec = 'zstd'"
+                              ' order by id desc limit 1').fetchone()
+        if row:
+            return row[0], str(row[1])
+        samples = []
+        for hash_, in self.db.execute('select hash from junit_blob order by random() limit ?',
+                                      (self.DICT_SAMPLES,)):
+            samples.extend(self._read_blobs([hash_]).itervalues())
+        if len(samples) < 10:
+            return None, None
+        dict_data = zstd.train_dictionary(self.DICT_SIZE, samples).as_bytes()
+        cursor = self.db.execute("insert into compression_dict values(null, 'zstd', ?)",
+                                 (buffer(dict_data),))
+        return cursor.lastrowid, dict_data
+
+    def _decompress(self, codec, data):
+        decompress = self.decompressors.get(codec)
+        if decompress is None:
+            if zstd is None:
+                raise ValueError('junit files compressed with %s need the zstandard module'
+                                 % codec)
+            kwargs = {}
+            if codec.startswith('zstd:'):
+                kwargs['dict_data'] = zstd.ZstdCompressionDict(str(self.db.execute(
+                    'select data from compression_dict where id = ?',
+                    (int(codec[5:]),)).fetchone()[0]))
+            decompress = zstd.ZstdDecompressor(**kwargs).decompress
+            self.decompressors[codec] = decompress
+        return decompress(data)
+
+    def _read_blobs(self, hashes):
+        """Return {hash: data} for the given junit blob hashes."""
+        return {str(hash_): self._decompress(codec, data) for hash_, codec, data in self.db.execute(
+            'select hash, codec, data from junit_blob where hash in (%s)'
+            % ','.join('?' * len(hashes)), hashes)}
 
     ### make_json
 
@@ -110,16 +356,18 @@ class Database(object):
         """
         Iterate through (buildid, gcs_path, started, finished) for each build under
         the given path that has not already been emitted.
+
+        Builds are read from the database as they're iterated through, so a full export
+        doesn't have to fit in memory.
         """
         self._init_incremental(incremental_table)
-        results = self.db.execute(
-            'select rowid, gcs_path, started_json, finished_json from build '
-            'where gcs_path like ?'
-            ' and finished_time >= ?' +
-            ' and rowid not in (select build_id from %s)'
-            ' order by finished_time' % incremental_table
-        #   ' limit 10000'
-            , (path + '%', min_started or 0)).fetchall()
+        condition, params = prefix_range('gcs_path', path)
+        results = self.db.cursor().execute(
+            'select build.rowid, gcs_path, started_json, finished_json from build'
+            ' left join %s on build_id = build.rowid'
+            ' where build_id is null and finished_time >= ? and %s'
+            ' order by finished_time' % (incremental_table, condition),
+            (min_started or 0,) + params)
         for rowid, path, started, finished in results:
             started = started and json.loads(started)
             finished = finished and json.loads(finished)
@@ -130,10 +378,13 @@ class Database(object):
         Return a list of file data under the given path. Intended for JUnit artifacts.
         """
         results = []
-        for dataz, in self.db.execute(
-                'select data from file where path between ? and ?',
-                (path, path + '\x7F')):
-            data = zlib.decompress(dataz)
+        for _, codec, dataz in self.db.execute(
+                'select path, codec, data from junit_file join junit_blob using (hash)'
+                ' where path between ? and ?'
+                " union all select path, 'zlib', data from file where path between ? and ?"
+                ' order by path',
+                (path, path + '\x7F') * 2):
+            data = self._decompress(codec, dataz)
             if data:
                 results.append(data)
         return results
@@ -150,3 +401,149 @@ class Database(object):
         self.db.commit()
         return gen
 
+
+class ShardedDatabase(object):
+    """
+    A Database split across several SQLite files, with the same interface.
+
+    Builds (and their junit files) are routed to a shard by a hash of their job directory,
+    so each shard is a fraction of the size, has its own writer lock, and can be queried
+    in parallel. Batched writes are split by shard and also run in parallel, one thread per
+    shard, so compressing and inserting one shard's junit files overlaps with the others.
+    Build ids are rowid * len(shards) + shard.
+    """
+
+    def __init__(self, path, shards, codec='zlib', level=None):
+        if path == ':memory:':
+            paths = [path] * shards
+        else:
+            base, ext = os.path.splitext(path)
+            paths = ['%s.%d%s' % (base, n, ext) for n in range(shards)]
+        self.shards = [Database(shard_path, codec, level) for shard_path in paths]
+        self.pool = ThreadPool(shards)
+
+    def shard_for_path(self, path):
+        """Return the index of the shard storing the build at path (or files under it)."""
+        job_dir = path.rstrip('/').rsplit('/', 1)[0]
+        if isinstance(job_dir, unicode):
+            job_dir = job_dir.encode('utf8')
+        return int(hashlib.md5(job_dir).hexdigest()[:8], 16) % len(self.shards)
+
+    def _split_id(self, build_id):
+        return build_id % len(self.shards), build_id // len(self.shards)
+
+    def _build_id(self, shard, rowid):
+        return rowid * len(self.shards) + shard
+
+    def _map(self, func, items=None):
+        """
+        Call func(shard), or func(shard, item) with each shard's entry in items, on every
+        shard in parallel, returning the results in order.
+        """
+        if items is None:
+            return self.pool.map(func, self.shards)
+        return self.pool.map(lambda (shard, item): func(shard, item), zip(self.shards, items))
+
+    def commit(self):
+        self._map(Database.commit)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for shard in self.shards:
+            shard.close()
+
+    def get_job_state(self, jobs_dir):
+        """
+        Like Database.get_job_state. A job's builds can be in several shards (as PR builds
+        are), so all job state is kept in the first shard.
+        """
+        state = self.shards[0]._get_stored_job_state(jobs_dir)
+        if state is None:
+            high_water = {}
+            pending = {}
+            for shard_high_water, shard_pending in self._map(
+                    lambda shard: shard._job_state_from_builds(jobs_dir)):
+                for job, build in shard_high_water.iteritems():
+                    if job not in high_water or pad_numbers(build) > pad_numbers(high_water[job]):
+                        high_water[job] = build
+                pending.update(shard_pending)
+            state = high_water, pending
+            self.update_job_state(jobs_dir, *state)
+        return state
+
+    def update_job_state(self, jobs_dir, high_water, pending):
+        self.shards[0].update_job_state(jobs_dir, high_water, pending)
+
+    ### make_db
+
+    def insert_build(self, build_dir, started, finished):
+        self.shards[self.shard_for_path(build_dir)].insert_build(build_dir, started, finished)
+
+    def insert_builds(self, builds):
+        builds_by_shard = [[] for _ in self.shards]
+        for build in builds:
+            builds_by_shard[self.shard_for_path(build[0])].append(build)
+        self._map(Database.insert_builds, builds_by_shard)
+
+    def get_builds_missing_junit(self):
+        results = self._map(lambda shard: shard.get_builds_missing_junit())
+        return [(self._build_id(n, rowid), path)
+                for n, rows in enumerate(results) for rowid, path in rows]
+
+    def insert_build_junits(self, build_id, junits):
+        shard, rowid = self._split_id(build_id)
+        self.shards[shard].insert_build_junits(rowid, junits)
+
+    def insert_builds_junits(self, builds_junits):
+        junits_by_shard = [[] for _ in self.shards]
+        for build_id, junits in builds_junits:
+            shard, rowid = self._split_id(build_id)
+            junits_by_shard[shard].append((rowid, junits))
+        self._map(Database.insert_builds_junits, junits_by_shard)
+
+    ### make_json
+
+    def get_builds(self, path='', min_started=None,
+                   incremental_table=Database.DEFAULT_INCREMENTAL_TABLE):
+        """
+        Like Database.get_builds, merging every shard's builds.
+
+        Builds are still generated in order of their finished time, and each shard's are
+        read as they're needed, so a full export doesn't have to fit in memory.
+        """
+        def shard_builds(n, shard):
+            for rowid, build_path, started, finished in shard.get_builds(
+                    path, min_started, incremental_table):
+                yield (finished and finished.get('timestamp'), self._build_id(n, rowid),
+                       build_path, started, finished)
+
+        for _, build_id, build_path, started, finished in heapq.merge(
+                *[shard_builds(n, shard) for n, shard in enumerate(self.shards)]):
+            yield build_id, build_path, started, finished
+
+    def test_results_for_build(self, path):
+        return self.shards[self.shard_for_path(path)].test_results_for_build(path)
+
+    def reset_emitted(self, incremental_table=Database.DEFAULT_INCREMENTAL_TABLE):
+        for shard in self.shards:
+            shard.reset_emitted(incremental_table)
+
+    def insert_emitted(self, rows_emitted, incremental_table=Database.DEFAULT_INCREMENTAL_TABLE):
+        rows_by_shard = [[] for _ in self.shards]
+        for build_id in rows_emitted:
+            shard, rowid = self._split_id(build_id)
+            rows_by_shard[shard].append(rowid)
+        return max(self._map(lambda shard, rows: shard.insert_emitted(rows, incremental_table),
+                             rows_by_shard))
+
+
+def open_database(path, shards=1, codec='zlib', level=None):
+    """
+    Open the database at path, split into the given number of shards if more than one.
+
+    New junit files are compressed with the given codec and level (see Database).
+    """
+    if shards > 1:
+        return ShardedDatabase(path, shards, codec, level)
+    return Database(path, codec, level)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python2
+
+# Copyright 2017 The Kubernetes Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks model.Database's queries on a synthetic database.
+
+The same database is queried as it was before migrations (no index, rollback journal,
+LIKE and NOT IN queries), and then after model.Database has migrated it.
+
+    ./model_benchmark.py --builds 5000000 --db /tmp/synthetic.db
+
+With --storage, junit storage is compared instead: database size and insert throughput
+with every file zlib-compressed at level 9 under its path, as before junit_blob, and
+with each codec. Pass real junit files to store (they're repeated across --builds
+builds), or synthetic ones are used:
+
+    ./model_benchmark.py --storage --builds 2000 /tmp/junit/*.xml
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import zlib
+
+import model
+
+
+# how many builds to store before the benchmarked ones, to train a zstd dictionary on
+DICT_BUILDS = 50
+
+BUCKETS = ['gs://kubernetes-jenkins/logs/', 'gs://kubernetes-jenkins/pr-logs/pull/',
+           'gs://other-bucket/logs/']
+
+
+def measure(description, func, *args):
+    start = time.time()
+    result = func(*args)
+    print '%-50s %8.3fs' % (description, time.time() - start)
+    return result
+
+
+def make_db(path, builds):
+    """Write a database with the original schema and the given number of builds."""
+    rand = random.Random(0)
+    db = sqlite3.connect(path)
+    db.executescript(model.MIGRATIONS[0])
+    db.execute('create table build_emitted(build_id integer primary key, gen)')
+    now = int(time.time())
+
+    def rows():
+        for n in xrange(builds):
+            started = now - (builds - n) * 10
+            path = '%sjob-%d/%d' % (BUCKETS[n % len(BUCKETS)], n % 1000, n)
+            finished = None
+            if rand.random() < 0.95:
+                finished = {'timestamp': started + 600, 'result': 'SUCCESS'}
+            yield (path, json.dumps({'timestamp': started}),
+                   finished and json.dumps(finished), finished and finished['timestamp'])
+
+    db.executemany('insert into build values(?,?,?,?)', rows())
+    # most builds have already been processed
+    db.execute('insert into build_junit_grabbed select rowid from build where rowid % 10 != 0')
+    db.execute('insert into build_emitted select rowid, 0 from build where rowid % 10 != 0')
+    db.commit()
+    db.close()
+
+
+def old_get_builds_missing_junit(db):
+    return db.execute('select rowid, gcs_path from build'
+                      ' where rowid not in (select build_id from build_junit_grabbed)').fetchall()
+
+
+def old_get_builds(db, min_started):
+    return [row[0] for row in db.execute(
+        'select rowid, gcs_path, started_json, finished_json from build'
+        ' where gcs_path like ? and finished_time >= ?'
+        ' and rowid not in (select build_id from build_emitted) order by finished_time',
+        ('%', min_started))]
+
+
+def main(args):
+    if not os.path.exists(args.db):
+        measure('creating %d builds' % args.builds, make_db, args.db, args.builds)
+    old = sqlite3.connect(args.db)
+    if old.execute('pragma user_version').fetchone()[0]:
+        sys.exit('%s has already been migrated, remove it first' % args.db)
+    min_started = int(time.time()) - 24 * 60 * 60
+
+    expected = [
+        measure('get_builds_missing_junit (NOT IN)', old_get_builds_missing_junit, old),
+        measure('get_builds, last day (NOT IN, no index)', old_get_builds, old, min_started),
+    ]
+    old.close()
+
+    db = measure('migrating', model.Database, args.db)
+    actual = [
+        measure('get_builds_missing_junit (LEFT JOIN)', db.get_builds_missing_junit),
+        measure('get_builds, last day (LEFT JOIN, index)',
+                lambda: [row[0] for row in db.get_builds(min_started=min_started)]),
+    ]
+    assert expected == actual, 'results differ!'
+    measure('get_job_state (from builds)', db.get_job_state, BUCKETS[0])
+    measure('get_job_state', db.get_job_state, BUCKETS[0])
+
+
+def synthetic_junits(builds, first=0):
+    """Generate {path: contents} junits for each build, with as much repetition as CI has.
+
+    Every build runs the same skipped suite, a tenth rerun an earlier build's unit tests
+    on the same commit, and the rest have their own results.
+    """
+    rand = random.Random(0)
+    skipped = '<testsuite>%s</testsuite>' % ''.join(
+        '<testcase name="[k8s.io] Skipped %d" time="0"><skipped/></testcase>' % n
+        for n in xrange(300))
+    for n in xrange(first, first + builds):
+        seed = n - n % 10 if n % 10 == 1 else n
+        cases = ''.join(
+            '<testcase name="[k8s.io] Test %d" time="%.3f">%s</testcase>' % (
+                t, random.Random(seed * 1000 + t).random() * 100,
+                '<failure>timed out waiting for pod %d</failure>' % seed if t % 37 == 0 else '')
+            for t in xrange(200))
+        yield n, {
+            'gs://logs/job-%d/%d/artifacts/junit_skipped.xml' % (n % 7, n): skipped,
+            'gs://logs/job-%d/%d/artifacts/junit_01.xml' % (n % 7, n):
+                '<testsuite>%s</testsuite>' % cases,
+            'gs://logs/job-%d/%d/artifacts/junit_runner.xml' % (n % 7, n):
+                '<testsuite><testcase name="Extract" time="%d"/></testsuite>'
+                % rand.randint(1, 100),
+        }
+
+
+def file_junits(paths, builds, first=0):
+    """Generate junits for each build from the given files, as if each build had them all."""
+    datas = [open(path).read() for path in paths]
+    for n in xrange(first, first + builds):
+        yield n, {'gs://logs/job/%d/artifacts/%s' % (n, os.path.basename(path)): data
+                  for path, data in zip(paths, datas)}
+
+
+def store_old(path, builds_junits):
+    db = sqlite3.connect(path)
+    db.executescript(model.MIGRATIONS[0])
+    db.executemany('replace into file values(?,?)', (
+        (path, buffer(zlib.compress(data, 9)))
+        for _, junits in builds_junits for path, data in junits.iteritems()))
+    db.commit()
+    db.close()
+
+
+def store(path, builds_junits, codec, level):
+    db = model.Database(path, codec, level)
+    batch = []
+    for build_junits in builds_junits:
+        batch.append(build_junits)
+        if len(batch) == 200:
+            db.insert_builds_junits(batch)
+            db.commit()
+            batch = []
+    db.insert_builds_junits(batch)
+    db.commit()
+    return db
+
+
+def storage_main(args):
+    paths = [p for pattern in args.junits for p in glob.glob(pattern)]
+    make_junits = lambda builds, first=0: list(file_junits(paths, builds, first) if paths
+                                               else synthetic_junits(builds, first))
+    builds_junits = make_junits(args.builds)
+    total = sum(len(data) for _, junits in builds_junits for data in junits.itervalues())
+    print '%d builds, %.1f MB of junit' % (args.builds, total / 1e6)
+
+    def report(description, db_path, elapsed):
+        size = sum(os.path.getsize(p) for p in glob.glob(db_path + '*'))
+        print '%-36s %8.3fs %8.1f MB/s inserted %8.1f MB on disk' % (
+            description, elapsed, total / 1e6 / elapsed, size / 1e6)
+
+    tmpdir = tempfile.mkdtemp(prefix='model_benchmark_')
+    try:
+        db_path = os.path.join(tmpdir, 'old.db')
+        start = time.time()
+        store_old(db_path, builds_junits)
+        report('file table, zlib level 9', db_path, time.time() - start)
+
+        codecs = [('zlib', 9), ('zlib', 6), ('zlib', 1)]
+        if model.zstd:
+            codecs += [('zstd', 3), ('zstd-dict', 3)]
+        else:
+            print '(zstandard is not installed, skipping zstd)'
+        for codec, level in codecs:
+            db_path = os.path.join(tmpdir, '%s-%d.db' % (codec, level))
+            description = 'junit_blob, %s level %d' % (codec, level)
+            if codec == 'zstd-dict':
+                # train the dictionary on builds stored before these, with their own ids
+                store(db_path, make_junits(DICT_BUILDS, args.builds), 'zlib', 6).db.close()
+                description += ' (+%d)' % DICT_BUILDS
+            start = time.time()
+            db = store(db_path, builds_junits, codec, level)
+            elapsed = time.time() - start
+            db.db.execute('pragma wal_checkpoint(truncate)')
+            report(description, db_path, elapsed)
+            db.db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('junits', nargs='*',
+                        help='with --storage, junit files to store for each build')
+    parser.add_argument('--builds', type=int, default=5000000,
+                        help='number of builds in the synthetic database')
+    parser.add_argument('--db', default='synthetic_build.db',
+                        help='path to create the synthetic database at (reused if unmigrated)')
+    parser.add_argument('--storage', action='store_true',
+                        help='compare ways of storing junit files instead')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    ARGS = parse_args(sys.argv[1:])
+    if ARGS.storage:
+        storage_main(ARGS)
+    else:
+        main(ARGS)
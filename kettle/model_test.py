@@ -14,7 +14,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
 import unittest
+import zlib
 
 import model
 
@@ -23,9 +29,31 @@ class ModelTest(unittest.TestCase):
     def setUp(self):
         self.db = model.Database(':memory:')
 
+    def tearDown(self):
+        self.db.close()
+
     def test_insert_build(self):
         self.db.insert_build('/some/dir/123', {'timestamp': 123}, {'timestamp': 140})
-        self.assertEqual(self.db.get_existing_builds('/some/'), {('dir', '123')})
+        self.assertEqual([path for _rowid, path, _started, _finished in self.db.get_builds()],
+                         ['/some/dir/123'])
+
+    def test_insert_builds(self):
+        self.db.insert_builds([('/some/dir/%d' % n, {'timestamp': n}, {'timestamp': n + 1})
+                               for n in range(1200)])
+        missing = dict(self.db.get_builds_missing_junit())
+        self.assertEqual(len(missing), 1200)
+        self.db.insert_builds_junits([(build_id, {path + '/junit.xml': path})
+                                      for build_id, path in missing.iteritems()])
+        self.assertEqual(self.db.get_builds_missing_junit(), [])
+
+        # only changed builds are replaced, and so have their junit fetched again
+        self.db.insert_builds([('/some/dir/%d' % n, {'timestamp': n}, {'timestamp': n + 2})
+                               for n in range(0, 1200, 100)] +
+                              [('/some/dir/%d' % n, {'timestamp': n}, {'timestamp': n + 1})
+                               for n in range(1, 1200, 100)])
+        self.assertEqual(sorted(path for _, path in self.db.get_builds_missing_junit()),
+                         sorted('/some/dir/%d' % n for n in range(0, 1200, 100)))
+        self.assertEqual(self.db.test_results_for_build('/some/dir/1/'), ['/some/dir/1'])
 
     def test_insert_junits(self):
         self.db.insert_build('/some/dir/123', {'timestamp': 123}, {'timestamp': 140})
@@ -34,6 +62,32 @@ class ModelTest(unittest.TestCase):
         self.db.insert_build_junits(1, {'/some/dir/123/foo.txt': 'example'})
         self.assertEqual(self.db.test_results_for_build('/some/dir/123/'), ['example'])
 
+    def test_insert_junits_dedup(self):
+        self.db.insert_builds_junits([
+            (1, {'/some/dir/1/junit_01.xml': 'same', '/some/dir/1/junit_02.xml': 'other'}),
+            (2, {'/some/dir/2/junit_01.xml': 'same'})])
+        self.db.insert_build_junits(3, {'/some/dir/3/junit_01.xml': 'same'})
+        self.assertEqual(self.db.db.execute('select count(*) from junit_blob').fetchone(), (2,))
+        self.assertEqual(self.db.test_results_for_build('/some/dir/1/'), ['same', 'other'])
+        self.assertEqual(self.db.test_results_for_build('/some/dir/3/'), ['same'])
+
+    def test_job_state(self):
+        now = int(time.time())
+        self.db.insert_builds([
+            ('/some/job/9', {'timestamp': 1}, {'timestamp': 2}),
+            ('/some/job/10', {'timestamp': now}, None),
+            ('/some/job/8', {'timestamp': 1}, None),  # too old to still be running
+            ('/some/other/a', {'timestamp': now}, {'timestamp': now}),
+            ('/some_/job/11', {'timestamp': now}, None)])
+        # the first time, state comes from the stored builds
+        self.assertEqual(self.db.get_job_state('/some/'),
+                         ({'job': '10', 'other': 'a'}, {('job', '10'): now}))
+
+        self.db.update_job_state('/some/', {'job': '12'}, {('job', '12'): 5})
+        self.assertEqual(self.db.get_job_state('/some/'),
+                         ({'job': '12', 'other': 'a'}, {('job', '12'): 5}))
+        self.assertEqual(self.db.get_job_state('/some_/'), ({'job': '11'}, {('job', '11'): now}))
+
     def test_incremental(self):
         def add_build(num):
             self.db.insert_build(
@@ -65,5 +119,177 @@ class ModelTest(unittest.TestCase):
         expect(set())
 
 
+class MigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='model_test_')
+        self.path = os.path.join(self.tmpdir, 'build.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_migrate(self):
+        # a database from before migrations were tracked
+        old = sqlite3.connect(self.path)
+        old.executescript(model.MIGRATIONS[0])
+        old.execute('insert into build values(?,?,?,?)',
+                    ('/some/dir/123', '{"timestamp": 123}', '{"timestamp": 140}', 140))
+        old.commit()
+        old.close()
+
+        db = model.Database(self.path)
+        self.assertEqual(db.db.execute('pragma user_version').fetchone(),
+                         (len(model.MIGRATIONS),))
+        self.assertEqual(db.db.execute('pragma journal_mode').fetchone(), ('wal',))
+        self.assertEqual(db.get_job_state('/some/'), ({'dir': '123'}, {}))
+        indexes = [name for (name,) in db.db.execute(
+            "select name from sqlite_master where type = 'index' and name like 'build_%'")]
+        self.assertEqual(indexes, ['build_finished_time'])
+        plan = db.db.execute('explain query plan select * from build where finished_time > 1'
+                            ' order by finished_time').fetchall()
+        self.assertIn('build_finished_time', str(plan))
+
+        # reopening doesn't reapply anything
+        model.Database(self.path)
+
+    def test_read_old_files(self):
+        # junit files written before junit_blob are still read, until they're replaced
+        old = sqlite3.connect(self.path)
+        old.executescript(model.MIGRATIONS[0])
+        for path, data in [('/some/dir/123/a.xml', 'a'), ('/some/dir/123/c.xml', 'c')]:
+            old.execute('insert into file values(?,?)', (path, buffer(zlib.compress(data, 9))))
+        old.commit()
+        old.close()
+
+        db = model.Database(self.path)
+        db.insert_build_junits(1, {'/some/dir/123/b.xml': 'b', '/some/dir/123/c.xml': 'new c'})
+        self.assertEqual(db.test_results_for_build('/some/dir/123/'), ['a', 'b', 'new c'])
+
+    def test_codecs(self):
+        with self.assertRaises(ValueError):
+            model.Database(self.path, codec='bzip2')
+        db = model.Database(self.path, codec='zlib', level=1)
+        db.insert_build_junits(1, {'/some/dir/123/junit.xml': 'data' * 100})
+        db.commit()
+        if model.zstd:
+            # files are read back whatever they were written with
+            db = model.Database(self.path, codec='zstd')
+            db.insert_build_junits(2, {'/some/dir/124/junit.xml': 'zstd data' * 100})
+        self.assertEqual(db.test_results_for_build('/some/dir/123/'), ['data' * 100])
+
+    @unittest.skipUnless(model.zstd, 'zstandard is not installed')
+    def test_zstd(self):
+        db = model.Database(self.path, codec='zstd')
+        db.insert_build_junits(1, {'/some/dir/123/junit.xml': 'data' * 100})
+        self.assertEqual(db.db.execute('select codec from junit_blob').fetchall(), [('zstd',)])
+        db.commit()
+        self.assertEqual(model.Database(self.path).test_results_for_build('/some/dir/123/'),
+                         ['data' * 100])
+
+    @unittest.skipUnless(model.zstd, 'zstandard is not installed')
+    def test_zstd_dict(self):
+        junit = '<testsuite><testcase name="Test %d" time="%d"/></testsuite>'
+        db = model.Database(self.path)
+        db.insert_builds_junits([(n, {'/some/dir/%d/junit.xml' % n: junit % (n, n) * 20})
+                                 for n in range(100)])
+        db.commit()
+        # a dictionary is trained on the files already stored, and used for new ones
+        db = model.Database(self.path, codec='zstd-dict')
+        db.insert_build_junits(100, {'/some/dir/100/junit.xml': junit % (100, 100)})
+        (dict_id,), = db.db.execute('select id from compression_dict').fetchall()
+        self.assertEqual(db.db.execute('select codec from junit_blob where rowid = 101')
+                         .fetchall(), [('zstd:%d' % dict_id,)])
+        db.commit()
+        db = model.Database(self.path)
+        self.assertEqual(db.test_results_for_build('/some/dir/100/'), [junit % (100, 100)])
+        self.assertEqual(db.test_results_for_build('/some/dir/7/'), [junit % (7, 7) * 20])
+
+
+    @unittest.skipUnless(model.zstd, 'zstandard is not installed')
+    def test_zstd_dict_retry(self):
+        junit = '<testsuite><testcase name="Test %d" time="%d"/></testsuite>'
+        db = model.Database(self.path, codec='zstd-dict')
+        db.DICT_RETRY_BLOBS = 20
+
+        def insert(numbers):
+            db.insert_builds_junits([(n, {'/some/dir/%d/junit.xml' % n: junit % (n, n) * 20})
+                                     for n in numbers])
+            return db.db.execute('select count(*) from compression_dict').fetchone()[0]
+
+        # too few files to train on, so plain zstd is used without sampling them every time
+        self.assertEqual(insert(range(5)), 0)
+        self.assertEqual(insert(range(5, 15)), 0)
+        self.assertEqual(db.db.execute('select distinct codec from junit_blob').fetchall(),
+                         [('zstd',)])
+        # until enough new files are stored
+        self.assertEqual(insert(range(15, 25)), 0)
+        self.assertEqual(insert([25]), 1)
+        self.assertEqual(db.test_results_for_build('/some/dir/3/'), [junit % (3, 3) * 20])
+
+
+class ShardedModelTest(ModelTest):
+    def setUp(self):
+        self.db = model.ShardedDatabase(':memory:', 3)
+
+    def test_insert_junits(self):
+        self.db.insert_build('/some/dir/123', {'timestamp': 123}, {'timestamp': 140})
+        [(build_id, path)] = self.db.get_builds_missing_junit()
+        self.assertEqual(path, '/some/dir/123')
+
+        self.db.insert_build_junits(build_id, {'/some/dir/123/foo.txt': 'example'})
+        self.assertEqual(self.db.get_builds_missing_junit(), [])
+        self.assertEqual(self.db.test_results_for_build('/some/dir/123/'), ['example'])
+
+    def test_insert_junits_dedup(self):
+        # contents are only shared within a shard
+        self.db.insert_builds([('/some/dir%d/1' % n, {'timestamp': 1}, None) for n in (1, 2)])
+        ids = {path: build_id for build_id, path in self.db.get_builds_missing_junit()}
+        self.db.insert_builds_junits([
+            (ids['/some/dir1/1'], {'/some/dir1/1/junit_01.xml': 'same',
+                                   '/some/dir1/1/junit_02.xml': 'other'}),
+            (ids['/some/dir2/1'], {'/some/dir2/1/junit_01.xml': 'same'})])
+        self.assertEqual(self.db.test_results_for_build('/some/dir1/1/'), ['same', 'other'])
+        self.assertEqual(self.db.test_results_for_build('/some/dir2/1/'), ['same'])
+
+    def test_job_state_across_shards(self):
+        # PR builds of one job are spread over shards, by their pull's directory
+        builds = [('/pr/pull/%d/job/%d' % (n, 100 + n), {'timestamp': 1}, {'timestamp': 2})
+                  for n in range(10)]
+        self.db.insert_builds(builds)
+        self.assertGreater(len({self.db.shard_for_path(path) for path, _, _ in builds}), 1)
+        self.assertEqual(self.db.get_job_state('/pr/'), ({'job': '109'}, {}))
+        self.db.update_job_state('/pr/', {'job': '110'}, {})
+        self.assertEqual(self.db.get_job_state('/pr/'), ({'job': '110'}, {}))
+
+    def test_get_builds_lazy(self):
+        for n in range(20):
+            self.db.insert_build('/some/dir%d/%d' % (n % 7, n),
+                                 {'timestamp': 100}, {'timestamp': 200 - n})
+        read = []
+
+        def counting(get_builds):
+            def wrapped(*args):
+                for row in get_builds(*args):
+                    read.append(row)
+                    yield row
+            return wrapped
+
+        for shard in self.db.shards:
+            shard.get_builds = counting(shard.get_builds)
+        # only the first build of each shard is read to find the first overall
+        next(self.db.get_builds())
+        self.assertEqual(len(read), len(self.db.shards))
+
+    def test_get_builds_order(self):
+        for n in range(20):
+            self.db.insert_build('/some/dir%d/%d' % (n % 7, n),
+                                 {'timestamp': 100}, {'timestamp': 200 - n})
+        self.assertGreater(len({self.db.shard_for_path('/some/dir%d/1' % n)
+                                for n in range(7)}), 1)
+        builds = list(self.db.get_builds())
+        self.assertEqual([finished['timestamp'] for _, _, _, finished in builds],
+                         range(181, 201))
+        self.assertEqual(len({build_id for build_id, _, _, _ in builds}), 20)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -32,6 +32,87 @@
 def dist(a, b, limit=None):
     return BerghelRoach(a).getDistance(b, limit or len(a) + len(b))
 
+
+# Patterns up to this length use the bit-parallel algorithm when it's enabled.
+# Past this, the big integer operations get slower than Berghel-Roach's diagonals.
+BIT_PARALLEL_MAX_LEN = 4096
+
+
+class Comparator(object):
+    """
+    Computes edit distances from one pattern to many targets.
+
+    Per-pattern state is prepared once: the Berghel-Roach arrays, and with
+    bitparallel=True (for patterns up to BIT_PARALLEL_MAX_LEN characters) the
+    character masks for Myers' bit-parallel algorithm.
+
+    Results are the same as BerghelRoach.getDistance: the exact distance when it's
+    within limit, otherwise some value greater than limit.
+    """
+
+    def __init__(self, pattern, bitparallel=False):
+        self.pattern = pattern
+        self.berghelRoach = BerghelRoach(pattern)
+        self.peq = None
+        if bitparallel and 0 < len(pattern) <= BIT_PARALLEL_MAX_LEN:
+            self.peq = {}
+            for i, c in enumerate(pattern):
+                self.peq[c] = self.peq.get(c, 0) | (1 << i)
+
+    def getDistance(self, target, limit):
+        if self.peq is None:
+            return self.berghelRoach.getDistance(target, limit)
+        main = abs(len(self.pattern) - len(target))
+        if main > limit:
+            return main
+        distance = myersDistance(self.peq, len(self.pattern), target, limit)
+        if distance > limit:
+            return limit + 1
+        return distance
+
+    def getDistances(self, targets, limit):
+        for target in targets:
+            yield self.getDistance(target, limit)
+
+
+def myersDistance(peq, m, target, limit):  # pylint: disable=too-many-locals
+    # Myers' bit-parallel edit distance, in Hyyro's formulation for the distance
+    # between whole strings (rather than searching for the pattern in the target).
+    #
+    # Bit i of pv/mv is set when D[i+1][j] - D[i][j] is +1/-1 for the current
+    # column j, and ph/mh are the same for horizontal differences. The score
+    # tracks the bottom row, D[m][j], and starts at D[m][0] = m.
+    #
+    # Each column is only 1 away from the next, so D[m][n] >= D[m][j] - (n - j),
+    # and the computation stops once that exceeds limit.
+    #
+    # This loop is the hot path of clustering, so the bit vectors are kept in locals
+    # rather than split into helpers that would be called for every character.
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv = mask
+    mv = 0
+    score = m
+    remaining = len(target)
+    for c in target:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        remaining -= 1
+        if score - remaining > limit:
+            return score - remaining
+        ph = (ph << 1) | 1
+        mh <<= 1
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv
+    return score
+
 # This is a modification of the original Berghel-Roach edit
 # distance (based on prior work by Ukkonen) described in
 #   ACM Transactions on Information Systems, Vol. 14, No. 1,
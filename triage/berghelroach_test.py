@@ -256,5 +256,36 @@ class BerghelRoachTest(unittest.TestCase, AbstractLevenshteinTestCase):
         self.verifySomeEdits(MAGNA, 40, 30)
 
 
+class ComparatorTest(unittest.TestCase, AbstractLevenshteinTestCase):
+    @staticmethod
+    def getInstance(s):
+        return berghelroach.Comparator(s)
+
+    def testGetDistances(self):
+        expected = [berghelroach.BerghelRoach('kevlar').getDistance(w, 2) for w in words]
+        self.assertEqual(list(self.getInstance('kevlar').getDistances(words, 2)), expected)
+
+
+class BitParallelComparatorTest(ComparatorTest):
+    @staticmethod
+    def getInstance(s):
+        return berghelroach.Comparator(s, bitparallel=True)
+
+    def testLongString(self):
+        self.verifySomeEdits(MAGNA, 8, 10)
+
+    def testLongStringMoreEdits(self):
+        self.verifySomeEdits(MAGNA, 40, 30)
+
+    def testMatchesBerghelRoach(self):
+        # including results beyond the limit
+        for a in words:
+            for b in words:
+                for limit in range(6):
+                    self.assertEqual(
+                        self.getInstance(a).getDistance(b, limit),
+                        berghelroach.BerghelRoach(a).getDistance(b, limit), (a, b, limit))
+
+
 if __name__ == '__main__':
     unittest.main()
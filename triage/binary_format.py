@@ -0,0 +1,204 @@
+# Copyright 2017 The Kubernetes Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+A compact binary encoding of summarize.py's failure_data.json, meant to be memory-mapped.
+
+Readers can look up a single cluster, or a single build column, without parsing the rest
+of the file. All integers are little-endian. The layout is:
+
+    header      magic, then (count, offset) for each following section
+    strings     (count + 1) uint32 offsets into the UTF-8 blob that follows them
+    builds      int64 columns (INT_COLUMNS), then uint32 string id columns (STRING_COLUMNS),
+                each with one entry per build
+    jobs        (name id, path id, first build row, build row count) uint32s, sorted by name
+    index       (cluster id, offset, length) for each cluster, sorted by id
+    clusters    one compact JSON object per cluster, as in failure_data.json
+
+Null integers are stored as NULL_INT, and null strings as NULL_STRING.
+'''
+
+# pylint: disable=invalid-name
+
+import json
+import mmap
+import struct
+
+
+MAGIC = 'TRIAGEB1'
+HEADER = struct.Struct('<8s8Q')
+JOB = struct.Struct('<4I')
+INDEX_ENTRY = struct.Struct('<20sQI')
+
+INT_COLUMNS = ('number', 'started', 'tests_failed', 'elapsed', 'tests_run')
+STRING_COLUMNS = ('result', 'executor', 'pr')
+
+NULL_INT = -2**63
+NULL_STRING = 2**32 - 1
+
+
+class StringTable(object):
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def add(self, s):
+        if s is None:
+            return NULL_STRING
+        if s not in self.ids:
+            self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return self.ids[s]
+
+    def pack(self):
+        encoded = [s.encode('utf8') if isinstance(s, unicode) else s for s in self.strings]
+        offsets = [0]
+        for s in encoded:
+            offsets.append(offsets[-1] + len(s))
+        return struct.pack('<%dI' % len(offsets), *offsets) + ''.join(encoded)
+
+
+def write(data, path):
+    """Write rendered failure data (as from summarize.render) to path."""
+    strings = StringTable()
+    build_count = len(data['builds']['cols']['started'])
+    numbers, jobs = _pack_jobs(data['builds'], build_count, strings)
+    builds = _pack_builds(data['builds']['cols'], numbers, strings)
+    strings_packed = strings.pack()
+
+    builds_offset = HEADER.size + len(strings_packed)
+    jobs_offset = builds_offset + len(builds)
+    index_offset = jobs_offset + len(jobs)
+    clusters = sorted(data['clustered'], key=lambda c: c['id'])
+    index, blobs = _pack_clusters(clusters, index_offset + INDEX_ENTRY.size * len(clusters))
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC,
+                            len(strings.strings), HEADER.size,
+                            build_count, builds_offset,
+                            len(data['builds']['jobs']), jobs_offset,
+                            len(clusters), index_offset))
+        f.write(strings_packed)
+        f.write(builds)
+        f.write(jobs)
+        f.write(index)
+        f.writelines(blobs)
+
+
+def _pack_jobs(builds, build_count, strings):
+    """Return (build numbers by row, packed jobs section)."""
+    # builds_to_columns only keeps build numbers in its per-job mapping.
+    numbers = [None] * build_count
+    jobs = []
+    for name, mapping in sorted(builds['jobs'].iteritems()):
+        if isinstance(mapping, list):  # dense [first number, count, first index]
+            mapping = {mapping[0] + n: mapping[2] + n for n in xrange(mapping[1])}
+        for number, index in mapping.iteritems():
+            numbers[index] = int(number)
+        first = min(mapping.itervalues())
+        jobs.append(JOB.pack(strings.add(name), strings.add(builds['job_paths'][name]),
+                             first, max(mapping.itervalues()) - first + 1))
+    return numbers, ''.join(jobs)
+
+
+def _pack_builds(cols, numbers, strings):
+    """Return the packed builds section."""
+    builds = []
+    for col in INT_COLUMNS:
+        values = numbers if col == 'number' else cols[col]
+        builds.append(struct.pack('<%dq' % len(numbers),
+                                  *[NULL_INT if v is None else v for v in values]))
+    for col in STRING_COLUMNS:
+        builds.append(struct.pack('<%dI' % len(numbers), *[strings.add(v) for v in cols[col]]))
+    return ''.join(builds)
+
+
+def _pack_clusters(clusters, offset):
+    """Return (packed index section, cluster blobs), for blobs starting at offset."""
+    index = []
+    blobs = []
+    for cluster in clusters:
+        blob = json.dumps(cluster, sort_keys=True, separators=(',', ':'))
+        if isinstance(blob, unicode):
+            blob = blob.encode('utf8')
+        index.append(INDEX_ENTRY.pack(str(cluster['id']), offset, len(blob)))
+        blobs.append(blob)
+        offset += len(blob)
+    return ''.join(index), blobs
+
+
+class Reader(object):
+    """Read a file written by write() through a memory map."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic,
+         self.string_count, self.strings_offset,
+         self.build_count, self.builds_offset,
+         self.job_count, self.jobs_offset,
+         self.cluster_count, self.index_offset) = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError('%s is not a triage binary file' % path)
+        self.blob_offset = self.strings_offset + 4 * (self.string_count + 1)
+
+    def close(self):
+        self.mm.close()
+
+    def string(self, n):
+        if n == NULL_STRING:
+            return None
+        start, end = struct.unpack_from('<2I', self.mm, self.strings_offset + 4 * n)
+        return self.mm[self.blob_offset + start:self.blob_offset + end].decode('utf8')
+
+    def column(self, name):
+        """Return a list of the given build column's values, ordered by build row."""
+        if name in INT_COLUMNS:
+            offset = self.builds_offset + 8 * self.build_count * INT_COLUMNS.index(name)
+            values = struct.unpack_from('<%dq' % self.build_count, self.mm, offset)
+            return [None if v == NULL_INT else v for v in values]
+        offset = (self.builds_offset + 8 * self.build_count * len(INT_COLUMNS) +
+                  4 * self.build_count * STRING_COLUMNS.index(name))
+        return [self.string(v)
+                for v in struct.unpack_from('<%dI' % self.build_count, self.mm, offset)]
+
+    def jobs(self):
+        """Return {job_name: (job_path, first_build_row, build_row_count)}."""
+        out = {}
+        for n in xrange(self.job_count):
+            name, path, first, count = JOB.unpack_from(self.mm, self.jobs_offset + JOB.size * n)
+            out[self.string(name)] = (self.string(path), first, count)
+        return out
+
+    def _index_entry(self, n):
+        return INDEX_ENTRY.unpack_from(self.mm, self.index_offset + INDEX_ENTRY.size * n)
+
+    def cluster_ids(self):
+        return [self._index_entry(n)[0] for n in xrange(self.cluster_count)]
+
+    def cluster(self, cluster_id):
+        """Return the cluster with the given id, or None if there isn't one."""
+        # binary search the index, which is sorted by id
+        lo, hi = 0, self.cluster_count
+        while lo < hi:
+            mid = (lo + hi) / 2
+            if self._index_entry(mid)[0] < cluster_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.cluster_count:
+            return None
+        entry_id, offset, length = self._index_entry(lo)
+        if entry_id != cluster_id:
+            return None
+        return json.loads(self.mm[offset:offset + length])
@@ -0,0 +1,78 @@
+#!/usr/bin/env python2
+
+# Copyright 2017 The Kubernetes Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=invalid-name,missing-docstring
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import binary_format
+import summarize
+
+
+class BinaryFormatTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='binary_format_test_')
+        self.path = os.path.join(self.tmpdir, 'failure_data.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        def build(job, number, **kwargs):
+            out = {'job': job, 'number': number, 'path': 'gs://logs/%s/%d' % (job, number),
+                   'started': 1000 + number, 'tests_failed': 1, 'tests_run': 10,
+                   'elapsed': 60, 'result': 'FAILURE'}
+            out.update(kwargs)
+            return out
+        builds = [build('some-job', 1), build('some-job', 2, result=u'SUCCESS \u2713'),
+                  build('some-job', 3), build('other-job', 5, elapsed=None),
+                  build('other-job', 7, executor='agent-1')]
+        builds = {b['path']: b for b in builds}
+        clustered = {
+            'some failure': {'test a': [{'build': 'gs://logs/some-job/1'},
+                                        {'build': 'gs://logs/other-job/7'}]},
+            'another failure': {'test b': [{'build': 'gs://logs/some-job/2'},
+                                           {'build': 'gs://logs/some-job/3'}]},
+        }
+        for failures in clustered.itervalues():
+            for tests in failures.itervalues():
+                for test in tests:
+                    test['failure_text'] = 'some failure'
+        data = summarize.render(builds, clustered)
+        binary_format.write(data, self.path)
+
+        reader = binary_format.Reader(self.path)
+        cols = data['builds']['cols']
+        for col in cols:
+            self.assertEqual(reader.column(col), cols[col])
+        self.assertEqual(reader.column('number'), [5, 7, 1, 2, 3])
+        self.assertEqual(reader.jobs(), {'other-job': ('gs://logs/other-job', 0, 2),
+                                         'some-job': ('gs://logs/some-job', 2, 3)})
+        self.assertEqual(len(data['clustered']), 2)
+        self.assertEqual(sorted(reader.cluster_ids()),
+                         sorted(c['id'] for c in data['clustered']))
+        for cluster in data['clustered']:
+            self.assertEqual(reader.cluster(cluster['id']), cluster)
+        self.assertEqual(reader.cluster('0' * 20), None)
+        self.assertEqual(reader.cluster('f' * 20), None)
+        reader.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -23,15 +23,28 @@ and emits JSON for rendering in a browser.
 
 
 import argparse
+import array
+import bisect
+import collections
+import contextlib
 import functools
 import hashlib
+import heapq
+import inspect
 import json
+import marshal
+import multiprocessing
 import os
 import re
+import resource
+import struct
 import sys
+import tempfile
+import time
 import zlib
 
 import berghelroach
+import binary_format
 
 editdist = berghelroach.dist
 
@@ -46,6 +59,7 @@ flakeReasonOrdinalRE = re.compile(
     r'|[0-9a-f]{12,32}' # hex garbage
     r'|(?<=minion-group-|default-pool-)[-0-9a-z]{4,}'  # node names
 )
+flakeReasonMapRE = re.compile(r'map\[([^][]*)\]')
 
 
 def normalize(s):
@@ -76,13 +90,31 @@ def normalize(s):
 
     if 'map[' in s:
         # Go's maps are in a random order. Try to sort them to reduce diffs.
-        s = re.sub(r'map\[([^][]*)\]',
-                   lambda m: 'map[%s]' % ' '.join(sorted(m.group(1).split())),
-                   s)
+        s = flakeReasonMapRE.sub(
+            lambda m: 'map[%s]' % ' '.join(sorted(m.group(1).split())),
+            s)
 
     return flakeReasonOrdinalRE.sub(repl, s)
 
 
+def normalize_batch(texts):
+    """
+    Normalize an iterable of failure texts, returning a list.
+
+    Failures often repeat verbatim, so each distinct text is only normalized once.
+    """
+    memo = {}
+    out = []
+    for text in texts:
+        fnorm = memo.get(text)
+        if fnorm is None:
+            fnorm = memo[text] = normalize(text)
+        out.append(fnorm)
+    STATS.counters['normalize_memo_hits'] += len(out) - len(memo)
+    STATS.counters['normalize_memo_misses'] += len(memo)
+    return out
+
+
 def normalize_name(name):
     """
     Given a test name, remove [...]/{...}.
@@ -94,7 +126,158 @@ def normalize_name(name):
     return name.strip()
 
 
-def make_ngram_counts(s, ngram_counts={}):
+class NgramCache(object):
+    """
+    A bounded LRU memo for make_ngram_counts.
+
+    Entries are keyed by a SHA1 digest of the text instead of the text itself,
+    and counts are stored as compact arrays. The cache can be saved to disk and
+    loaded by the next run, so unchanged failures don't need to be recounted.
+    """
+
+    SIZE = 64
+    # record layout on disk: digest followed by SIZE ints
+    RECORD_LEN = 20 + SIZE * array.array('i').itemsize
+
+    def __init__(self, max_size=500000):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.new = None  # entries put since the last pop_new(), if recording
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(s):
+        if isinstance(s, unicode):
+            s = s.encode('utf8')
+        return hashlib.sha1(s).digest()
+
+    def get(self, key):
+        counts = self.entries.pop(key, None)
+        if counts is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = counts  # mark as most recently used
+        return counts
+
+    def put(self, key, counts):
+        self.entries.pop(key, None)
+        self.entries[key] = counts
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        if self.new is not None:
+            self.new[key] = counts
+
+    def record_new(self):
+        """Start recording new entries, so a worker process can send them to its parent."""
+        self.new = {}
+
+    def pop_new(self):
+        """Return the entries put since the last call (if recording), and forget them."""
+        new = self.new or {}
+        if self.new is not None:
+            self.new = {}
+        return new
+
+    def update(self, entries):
+        """Put entries returned by a worker process's pop_new()."""
+        for key, counts in entries.iteritems():
+            self.put(key, counts)
+
+    def load(self, path):
+        """Add entries saved by a previous run. Missing files are ignored."""
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            while True:
+                record = f.read(self.RECORD_LEN)
+                if len(record) < self.RECORD_LEN:
+                    break
+                counts = array.array('i')
+                counts.fromstring(record[20:])
+                self.put(record[:20], counts)
+
+    def save(self, path):
+        """Write entries, least recently used first, so load() keeps their order."""
+        with open(path + '.tmp', 'wb') as f:
+            for key, counts in self.entries.iteritems():
+                f.write(key)
+                f.write(counts.tostring())
+        os.rename(path + '.tmp', path)
+
+
+NGRAM_CACHE = NgramCache()
+
+
+def init_worker():
+    """Set up a clustering worker process."""
+    NGRAM_CACHE.record_new()
+
+
+class Stats(object):
+    """
+    Resource usage and counters for each stage of a run, for finding which stage regressed.
+
+    Hot paths add to counters (ngram_checks, editdist_calls, ...), and each stage records
+    how much they changed, along with its wall time, CPU time (including worker processes
+    that have exited), and the peak RSS so far.
+    """
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.stages = []
+
+    def snapshot(self):
+        """Return the current counters, including the ngram cache's."""
+        counters = self.counters.copy()
+        counters['ngram_cache_hits'] += NGRAM_CACHE.hits
+        counters['ngram_cache_misses'] += NGRAM_CACHE.misses
+        return counters
+
+    @staticmethod
+    def usage():
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = (self_usage.ru_utime + self_usage.ru_stime +
+               children.ru_utime + children.ru_stime)
+        return cpu, max(self_usage.ru_maxrss, children.ru_maxrss)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        counters = self.snapshot()
+        start = time.time()
+        cpu, _ = self.usage()
+        yield
+        cpu_end, peak_rss = self.usage()
+        counters = self.snapshot() - counters
+        stage = {
+            'name': name,
+            'wall_seconds': round(time.time() - start, 3),
+            'cpu_seconds': round(cpu_end - cpu, 3),
+            'peak_rss_kb': peak_rss,
+            'counters': dict(counters),
+        }
+        for cache in ('ngram_cache', 'normalize_memo'):
+            lookups = counters[cache + '_hits'] + counters[cache + '_misses']
+            if lookups:
+                stage[cache + '_hit_rate'] = round(counters[cache + '_hits'] / float(lookups), 4)
+        self.stages.append(stage)
+        print 'stage %s: %.1fs wall, %.1fs cpu, %dMB peak rss' % (
+            name, stage['wall_seconds'], stage['cpu_seconds'], peak_rss / 1024)
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump({'stages': self.stages}, f, indent=2, sort_keys=True)
+
+
+STATS = Stats()
+
+
+def make_ngram_counts(s):
     """
     Convert a string into a histogram of frequencies for different byte combinations.
     This can be used as a heuristic to estimate edit distance between two strings in
@@ -102,18 +285,19 @@ def make_ngram_counts(s, ngram_counts={}):
 
     Instead of counting each ngram individually, they are hashed into buckets.
     This makes the output count size constant.
-    """
-
-    # Yes, I'm intentionally memoizing here.
-    # pylint: disable=dangerous-default-value
 
-    size = 64
-    if s not in ngram_counts:
+    Results are memoized in NGRAM_CACHE.
+    """
+    key = NGRAM_CACHE.key(s)
+    counts = NGRAM_CACHE.get(key)
+    if counts is None:
+        size = NgramCache.SIZE
         counts = [0] * size
         for x in xrange(len(s)-3):
             counts[zlib.crc32(s[x:x+4].encode('utf8')) & (size - 1)] += 1
-        ngram_counts[s] = counts  # memoize
-    return ngram_counts[s]
+        counts = array.array('i', counts)
+        NGRAM_CACHE.put(key, counts)
+    return counts
 
 
 def ngram_editdist(a, b):
@@ -134,166 +318,748 @@ def ngram_editdist(a, b):
     guaranteed to exceed some limit (being a lower bound), or as a proxy when
     the exact edit distance computation is too expensive (for long inputs).
     """
-    counts_a = make_ngram_counts(a)
-    counts_b = make_ngram_counts(b)
-    return sum(abs(x-y) for x, y in zip(counts_a, counts_b))/4
+    return ngram_counts_dist(make_ngram_counts(a), make_ngram_counts(b))
+
+
+def ngram_counts_dist(counts_a, counts_b):
+    """Compute ngram_editdist from two ngram count histograms."""
+    # This is the innermost loop of clustering: an explicit loop is much faster
+    # than sum(abs(x-y) for ...) on both CPython and PyPy.
+    total = 0
+    for x, y in zip(counts_a, counts_b):
+        if x > y:
+            total += x - y
+        else:
+            total += y - x
+    return total/4
 
 
 def make_ngram_counts_digest(s):
     """
     Returns a hashed version of the ngram counts.
     """
-    return hashlib.sha1(str(make_ngram_counts(s))).hexdigest()[:20]
+    return hashlib.sha1(str(list(make_ngram_counts(s)))).hexdigest()[:20]
 
 
-def file_memoize(description, name):
+class StageCache(object):
     """
-    Decorator to save a function's results to a file.
+    Saves the results of expensive stages, keyed by a digest of their inputs.
+
+    Input files are keyed by their contents, and other arguments by their marshalled
+    values, except for the results of other cached stages, which are keyed by the key
+    they were computed (or loaded) with. So a change to the input files invalidates
+    every stage that depends on them, without hashing large intermediate results.
+
+    Entries are stored as zlib-compressed marshal data, which loads much faster than
+    JSON. The least recently used entries are removed once they exceed max_bytes.
+    """
+
+    VERSION = 1  # bump when stage outputs change, to invalidate old entries.
+
+    def __init__(self, path=None, max_bytes=2 << 30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.result_keys = {}  # {id(result): (result, key)}
+
+    def entry_paths(self):
+        """List the paths of the entries, leaving any other files in path alone."""
+        if not self.path or not os.path.isdir(self.path):
+            return []
+        return [os.path.join(self.path, name) for name in os.listdir(self.path)
+                if name.endswith('.marshal.z')]
+
+    def invalidate(self):
+        """Remove every entry."""
+        for path in self.entry_paths():
+            os.remove(path)
+
+    @staticmethod
+    def file_digest(path):
+        if path is None:
+            return 'None'
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), ''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def value_digest(self, value):
+        if id(value) in self.result_keys:
+            return self.result_keys[id(value)][1]
+        return hashlib.sha1(marshal.dumps(value)).hexdigest()
+
+    def remember(self, result, key):
+        """Key result (and its items, if it's a tuple) for stages that take it as input."""
+        # keep a reference to the result, so its id isn't reused.
+        self.result_keys[id(result)] = (result, key)
+        if isinstance(result, tuple):
+            for n, item in enumerate(result):
+                self.result_keys[id(item)] = (item, '%s.%d' % (key, n))
+
+    def entry_path(self, name, key):
+        return os.path.join(self.path, '%s-%s.marshal.z' % (name, key[:20]))
+
+    def load(self, name, key):
+        path = self.entry_path(name, key)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            data = marshal.loads(zlib.decompress(f.read()))
+        os.utime(path, None)  # mark as recently used
+        return data
+
+    def save(self, name, key, data):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        path = self.entry_path(name, key)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(zlib.compress(marshal.dumps(data), 1))
+        os.rename(path + '.tmp', path)
+        self.cleanup(keep=path)
+
+    def cleanup(self, keep=None):
+        """Remove the least recently used entries until they fit in max_bytes."""
+        entries = []
+        for path in self.entry_paths():
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                os.remove(path)
+                total -= size
+
+
+STAGE_CACHE = StageCache()
+
+
+def stage_cache(description, name, files=(), ignore=(), on_load=None):
+    """
+    Decorator to save a function's results in STAGE_CACHE, if it has a path.
+
+    Args:
+        description: what the function does, for progress output
+        name: prefix for the cache entries
+        files: names of arguments that are paths of input files
+        ignore: names of arguments that don't affect the result
+        on_load: optional function to pass results loaded from the cache through
     """
     def inner(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            if os.path.exists(name):
-                data = json.load(open(name))
-                print 'done (cached)', description
+            if not STAGE_CACHE.path:
+                data = func(*args, **kwargs)
+                print 'done', description
                 return data
+            digest = hashlib.sha1('%s %d' % (name, StageCache.VERSION))
+            for arg, value in sorted(inspect.getcallargs(func, *args, **kwargs).iteritems()):
+                if arg in ignore:
+                    continue
+                if arg in files:
+                    value = StageCache.file_digest(value)
+                else:
+                    value = STAGE_CACHE.value_digest(value)
+                digest.update('%s=%s ' % (arg, value))
+            key = digest.hexdigest()
+            data = STAGE_CACHE.load(name, key)
+            if data is not None:
+                if on_load:
+                    data = on_load(data)
+                print 'done (cached)', description
             else:
                 data = func(*args, **kwargs)
-                json.dump(data, open(name, 'w'))
+                STAGE_CACHE.save(name, key, data)
                 print 'done', description
-                return data
+            STAGE_CACHE.remember(data, key)
+            return data
         wrapper.__wrapped__ = func
         return wrapper
     return inner
 
 
-@file_memoize('loading failed tests', 'failed.json')
-def load_failures(builds_file, tests_file):
+def read_rows(path):
+    """
+    Generate rows from a file containing either a JSON array or newline-delimited JSON
+    objects (one per line, as written by kettle's make_json or a BigQuery export).
+
+    Newline-delimited files are parsed one row at a time, so they're never fully in memory.
+    """
+    with open(path) as f:
+        first = f.read(64).lstrip()[:1]
+        f.seek(0)
+        if first == '[':
+            for row in json.load(f):
+                yield row
+            return
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+# The only build fields that clustering and rendering use.
+BUILD_FIELDS = ('path', 'job', 'number', 'started', 'elapsed', 'tests_run', 'tests_failed',
+                'result', 'executor')
+# The build fields that load_failures interns.
+BUILD_STRING_FIELDS = ('path', 'job', 'result', 'executor')
+
+
+def intern_failures((builds, failed_tests)):
+    """
+    Intern repeated strings in load_failures' results, as load_failures does.
+
+    Results loaded from the stage cache have a separate copy of every string, which takes
+    more memory, and breaks the assumption that identical failure texts are the same object.
+    """
+    strings = {}
+    intern_str = lambda s: strings.setdefault(s, s)
+    for build in builds.itervalues():
+        for attr in BUILD_STRING_FIELDS:
+            if attr in build:
+                build[attr] = intern_str(build[attr])
+    interned_tests = {}
+    for name, tests in failed_tests.iteritems():
+        name = intern_str(name)
+        for test in tests:
+            test['build'] = intern_str(test['build'])
+            test['name'] = name
+            test['failure_text'] = intern_str(test['failure_text'])
+        interned_tests[name] = tests
+    return {build['path']: build for build in builds.itervalues()}, interned_tests
+
+
+@stage_cache('loading failed tests', 'failed', files=('builds_file', 'tests_file'),
+             on_load=intern_failures)
+def load_failures(builds_file, tests_file=None):
+    """
+    Load builds and failed tests.
+
+    Build rows may include a list of their tests under 'test', as emitted by kettle,
+    in which case the failures are taken from them. Only the fields in BUILD_FIELDS and
+    the build, name and failure_text of tests are kept, and repeated strings (build paths,
+    job and test names, failure texts) are interned to share memory.
+
+    Returns:
+        ({build_path: build}, {test_name: [failed_test, ...]})
+    """
+    strings = {}
+    intern_str = lambda s: strings.setdefault(s, s)
+
     builds = {}
-    for build in json.load(open(builds_file)):
-        if not build['started'] or not build['number']:
+    failed_tests = {}
+
+    def add_failure(build, name, failure_text):
+        name = intern_str(name)
+        failed_tests.setdefault(name, []).append(
+            {'build': intern_str(build), 'name': name, 'failure_text': intern_str(failure_text)})
+
+    for row in read_rows(builds_file):
+        for test in row.get('test') or ():
+            if test.get('failed'):
+                add_failure(row['path'], test['name'], test['failure_text'])
+        if not row.get('started') or not row.get('number'):
             continue
+        build = {k: row[k] for k in BUILD_FIELDS if k in row}
         for attr in ('started', 'tests_failed', 'number', 'tests_run'):
             build[attr] = int(build[attr])
-        build['elapsed'] = int(float(build['elapsed']))
+        if build.get('elapsed') is not None:
+            build['elapsed'] = int(float(build['elapsed']))
+        for attr in BUILD_STRING_FIELDS:
+            if attr in build:
+                build[attr] = intern_str(build[attr])
         if 'pr-logs' in build['path']:
             build['pr'] = build['path'].split('/')[-3]
         builds[build['path']] = build
 
-    failed_tests = {}
-    for test in json.load(open(tests_file)):
-        failed_tests.setdefault(test['name'], []).append(test)
+    if tests_file:
+        for test in read_rows(tests_file):
+            add_failure(test['build'], test['name'], test['failure_text'])
     for tests in failed_tests.itervalues():
         tests.sort(key=lambda t: t['build'])
 
     return builds, failed_tests
 
 
-def find_match(fnorm, clusters):
-    for ngram_dist, other in sorted((ngram_editdist(fnorm, x), x) for x in clusters):
+class NgramIndex(object):
+    """
+    An index of cluster keys that can quickly find keys that might be within the
+    10% edit distance limit used by find_match.
+
+    The counts from make_ngram_counts sum to the number of ngrams in a string (len - 3),
+    and the difference between two sums is a lower bound on the distance between their
+    histograms. Keys are kept sorted by that sum, so only a window of keys with similar
+    lengths need to have their ngram distance computed.
+
+    Each key's histogram is stored alongside it, so scoring the window doesn't need
+    to go through the make_ngram_counts memo.
+    """
+
+    def __init__(self, keys=()):
+        self.totals = []
+        self.keys = []
+        self.counts = []
+        for key in keys:
+            self.add(key)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        total = max(0, len(key) - 3)
+        pos = bisect.bisect_right(self.totals, total)
+        self.totals.insert(pos, total)
+        self.keys.insert(pos, key)
+        self.counts.insert(pos, make_ngram_counts(key))
+
+    def candidates(self, fnorm):
+        """
+        Generate (ngram_dist, key) for the keys whose ngram distance is within
+        the limit, in order of increasing ngram distance.
+
+        Candidates are ordered lazily, since find_match usually stops at one of the first.
+        """
+        # ngram_editdist <= limit requires |Ta - Tb| <= 4 * limit + 3, and since
+        # limit <= (Ta + Tb + 6) * 0.05, Tb must be within this window.
+        total = max(0, len(fnorm) - 3)
+        lo = bisect.bisect_left(self.totals, total * 2 / 3.0 - 3.5)
+        hi = bisect.bisect_right(self.totals, total * 1.5 + 5.25)
+        counts = make_ngram_counts(fnorm)
+        keys = self.keys
+        heap = []
+        for n in xrange(lo, hi):
+            ngram_dist = ngram_counts_dist(counts, self.counts[n])
+            if ngram_dist <= int((len(fnorm)+len(keys[n]))/2.0 * 0.10):
+                heap.append((ngram_dist, keys[n]))
+        STATS.counters['ngram_checks'] += hi - lo
+        STATS.counters['ngram_candidates'] += len(heap)
+        heapq.heapify(heap)
+        while heap:
+            yield heapq.heappop(heap)
+
+
+def find_match(fnorm, index):
+    match = find_match_candidate(fnorm, index)
+    return match and match[1]
+
+
+def find_match_candidate(fnorm, index, bound=None):
+    """
+    Like find_match, but returns the matching (ngram_dist, key), or None.
+
+    If bound is given, only candidates ordered before that (ngram_dist, key) are tried.
+    """
+    comparator = None
+    counters = STATS.counters
+    for ngram_dist, other in index.candidates(fnorm):
+        if bound and (ngram_dist, other) >= bound:
+            break
         # allow up to 10% differences
         limit = int((len(fnorm)+len(other))/2.0 * 0.10)
 
-        if ngram_dist > limit:
-            continue
-
         if limit <= 1 and other != fnorm:  # no chance
+            counters['editdist_early_rejects'] += 1
             continue
 
-        dist = editdist(fnorm, other, limit)
+        if comparator is None:
+            comparator = berghelroach.Comparator(fnorm)
+        counters['editdist_calls'] += 1
+        dist = comparator.getDistance(other, limit)
 
         if dist < limit:
-            return other
+            return ngram_dist, other
 
 
-def cluster_test(tests):
+def cluster_test(tests, clusters=None):
     """
     Compute failure clusters given a list of failures for one test.
 
     Args:
         tests: list of failed test dictionaries, with 'failure_text' keys
+        clusters: optional existing clusters to add the failures to
     Returns:
         {failure_text: [failure_in_cluster_1, failure_in_cluster_2, ...]}
     """
-    clusters = {}
+    clusters = dict(clusters or {})
+    index = NgramIndex(clusters)
 
-    for test in tests:
-        ftext = test['failure_text']
-        fnorm = normalize(ftext)
+    for test, fnorm in zip(tests, normalize_batch(t['failure_text'] for t in tests)):
         if fnorm in clusters:
             clusters[fnorm].append(test)
         else:
-            other = find_match(fnorm, clusters)
+            other = find_match(fnorm, index)
             if other:
                 clusters[other].append(test)
             else:
                 clusters[fnorm] = [test]
+                index.add(fnorm)
     return clusters
 
 
-@file_memoize('clustering inside each test', 'failed_clusters_local.json')
-def cluster_local(failed_tests):
+def cluster_test_worker((test_name, tests, clusters)):
+    counters = STATS.snapshot()
+    clusters = cluster_test(tests, clusters)
+    return test_name, clusters, STATS.snapshot() - counters, NGRAM_CACHE.pop_new()
+
+
+@stage_cache('clustering inside each test', 'failed_clusters_local', ignore=('jobs',))
+def cluster_local(failed_tests, jobs=1):
     """Cluster together the failures for each test. """
+    return cluster_tests([(test_name, tests, None)
+                          for test_name, tests in failed_tests.iteritems()], jobs)
+
+
+def cluster_tests(work, jobs=1):
+    """Run cluster_test for each (test_name, tests, clusters) in work.
+
+    Tests are clustered independently, so with jobs > 1 they are sharded across a pool
+    of worker processes. The largest tests are scheduled first so that a few big tests
+    don't end up running alone at the end.
+
+    Returns:
+        {test_name: {failure_text: [failure_1, failure_2, ...], ...}, ...}
+    """
     clustered = {}
-    for test_name, tests in sorted(failed_tests.iteritems(), key=lambda x: len(x[1]), reverse=True):
-        print len(tests), test_name
-        clustered[test_name] = cluster_test(tests)
+    work = sorted(work, key=lambda x: len(x[1]), reverse=True)
+    sizes = {test_name: len(tests) for test_name, tests, _ in work}
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, init_worker)
+        results = pool.imap_unordered(cluster_test_worker, work)
+    else:
+        results = (cluster_test_worker(item) for item in work)
+    try:
+        for n, (test_name, clusters, counters, ngram_counts) in enumerate(results, 1):
+            print '%d/%d %d %s' % (n, len(work), sizes[test_name], test_name)
+            clustered[test_name] = clusters
+            if pool:
+                # counted in a worker process
+                STATS.counters.update(counters)
+                NGRAM_CACHE.update(ngram_counts)
+    except KeyboardInterrupt:
+        if pool:
+            pool.terminate()
+        raise
+    else:
+        if pool:
+            pool.close()
+            pool.join()
     return clustered
 
 
-@file_memoize('clustering across tests', 'failed_clusters_global.json')
-def cluster_global(clustered, previous_clustered):
+@stage_cache('clustering across tests', 'failed_clusters_global', ignore=('jobs',))
+def cluster_global(clustered, previous_clustered, previous_membership=None, jobs=1):
     """Combine together clustered failures for each test.
 
     This is done hierarchically for efficiency-- each test's failures are likely to be similar,
     reducing the number of clusters that need to be paired up at this stage.
 
+    With jobs > 1, keys are matched in growing batches. Each batch's keys are matched in
+    parallel against the clusters that existed before the batch, so the sequential pass
+    only has to check the few clusters added during the batch, and produces exactly the
+    same clusters. One MatchPool serves every batch.
+
     Args:
-        {test_name: {failure_text: [failure_1, failure_2, ...], ...}, ...}
+        clustered: {test_name: {failure_text: [failure_1, failure_2, ...], ...}, ...}
+        previous_clustered: optional clusters from a previous run to seed keys from
+        previous_membership: optional {test_name: {failure_text: global_key}} from a
+            previous run, as returned by cluster_membership. Local clusters found in it
+            join the same global cluster again without searching for a match.
+        jobs: number of worker processes to match keys with
     Returns:
         {failure_text: [(test_name, [failure_1, failure_2, ...]), ...], ...}
     """
-    clusters = {}
+    previous_membership = previous_membership or {}
+    clusters = seed_clusters(previous_clustered)
+    ordered = [(test_name, sorted(cluster.iteritems(), key=lambda x: len(x[1]), reverse=True))
+               for test_name, cluster in sorted(
+                   clustered.iteritems(),
+                   key=lambda (k, v): sum(len(x) for x in v.itervalues()),
+                   reverse=True)]
+
+    index = NgramIndex(clusters)
+    matcher = MatchPool(index, jobs) if jobs > 1 else None
+    try:
+        for test_name, key, tests, batch in global_work(
+                ordered, clusters, previous_membership, matcher):
+            other = find_global_match(
+                key, test_name, clusters, previous_membership, index, batch) or key
+            if other not in clusters:
+                clusters[other] = {}
+                index.add(other)
+                if batch:
+                    batch[0].add(other)
+                if matcher:
+                    matcher.add(other)
+            clusters[other].setdefault(test_name, []).extend(tests)
+    finally:
+        # the workers are idle unless this is an exception, so there's nothing to wait for
+        if matcher:
+            matcher.terminate()
+
+    # If we seeded clusters using the previous run's keys, some of those
+    # clusters may have disappeared. Remove the resulting empty entries.
+    for k in {k for k, v in clusters.iteritems() if not v}:
+        clusters.pop(k)
 
+    return clusters
+
+
+def seed_clusters(previous_clustered):
+    """Return empty clusters for the keys of a previous run's clusters."""
+    clusters = {}
     if previous_clustered:
         # seed clusters using output from the previous run
         n = 0
-        for cluster in previous_clustered:
-            key = cluster['key']
-            if key != normalize(key):
+        keys = [cluster['key'] for cluster in previous_clustered]
+        for key, key_norm in zip(keys, normalize_batch(keys)):
+            if key != key_norm:
                 print 'WTF'
                 print key
-                print normalize(key)
+                print key_norm
                 n += 1
                 continue
-            clusters[cluster['key']] = {}
+            clusters[key] = {}
         print 'Seeding with %d previous clusters' % len(clusters)
         if n:
             print '!!! %d clusters lost from different normalization! !!!' % n
+    return clusters
 
 
-    for n, (test_name, cluster) in enumerate(
-            sorted(clustered.iteritems(),
-                   key=lambda (k, v): sum(len(x) for x in v.itervalues()),
-                   reverse=True),
-            1):
-        print '%d/%d %d %s' % (n, len(clustered), len(cluster), test_name)
-        for key, tests in sorted(cluster.iteritems(), key=lambda x: len(x[1]), reverse=True):
-            if key in clusters:
-                clusters[key].setdefault(test_name, []).extend(tests)
-            else:
-                other = find_match(key, clusters)
-                if other:
-                    clusters[other].setdefault(test_name, []).extend(tests)
-                else:
-                    clusters[key] = {test_name: list(tests)}
+def global_work(ordered, clusters, previous_membership, matcher):
+    """
+    Generate (test_name, key, tests, batch) for each local cluster to merge in cluster_global,
+    printing progress as each test starts.
 
-    # If we seeded clusters using the previous run's keys, some of those
-    # clusters may have disappeared. Remove the resulting empty entries.
-    for k in {k for k, v in clusters.iteritems() if not v}:
-        clusters.pop(k)
+    Without a matcher, batch is None. Otherwise keys are matched by the matcher in growing
+    batches, as each batch starts, and batch is (batch_index, matches) for the key's batch:
+    matches has the match for each of the batch's keys against the index as it was when the
+    batch started, and batch_index is an empty NgramIndex for the keys added during the batch.
+    """
+    items = [(n, test_name, key, tests)
+             for n, (test_name, cluster) in enumerate(ordered, 1)
+             for key, tests in cluster]
+    batch = None
+    batch_end = 0
+    batch_size = matcher.jobs * 16 if matcher else 0
+    last_n = 0
+    for pos, (n, test_name, key, tests) in enumerate(items):
+        if matcher and pos == batch_end:
+            batch_end = min(len(items), pos + batch_size)
+            batch_size = min(batch_size * 2, MATCH_BATCH_MAX)
+            batch = NgramIndex(), matcher.match(
+                [k for _, t, k, _ in items[pos:batch_end]
+                 if k not in clusters and k not in previous_membership.get(t, {})])
+        if n != last_n:
+            print '%d/%d %d %s' % (n, len(ordered), len(ordered[n - 1][1]), test_name)
+            last_n = n
+        yield test_name, key, tests, batch
+
+
+def find_global_match(key, test_name, clusters, previous_membership, index, batch):
+    """Return the key of the global cluster to merge a local cluster into, or None.
+
+    batch is as generated by global_work.
+    """
+    other = previous_membership.get(test_name, {}).get(key)
+    if other:
+        return other
+    if key in clusters:
+        return key
+    if batch:
+        # A match from the batch's keys is right if it comes before the one found
+        # in the index as it was when the batch started.
+        batch_index, matches = batch
+        match = find_match_candidate(key, batch_index, matches[key]) or matches[key]
+        return match and match[1]
+    return find_match(key, index)
+
+
+MATCH_BATCH_MAX = 1 << 14
+# the NgramIndex searched by match_batch_worker: set while a MatchPool forks its workers,
+# which keep their own copies
+MATCH_INDEX = None
+
+
+class MatchPool(object):
+    """
+    Worker processes that run find_match_candidate for batches of keys against an NgramIndex,
+    for cluster_global.
 
-    return clusters
+    The workers are forked once, with a copy of the index. Keys added to the index after
+    that are also passed to add(), which appends them to a log file. Before matching a
+    batch, each worker adds the keys logged since its last batch to its copy, so one pool
+    can serve every batch as the index grows.
+    """
+
+    def __init__(self, index, jobs):
+        global MATCH_INDEX  # pylint: disable=global-statement
+        self.jobs = jobs
+        self.added = []  # keys added since the last batch
+        fd, self.log_path = tempfile.mkstemp(prefix='summarize_match_')
+        self.log = os.fdopen(fd, 'wb')
+        MATCH_INDEX = index
+        try:
+            self.pool = multiprocessing.Pool(jobs, init_match_worker, (self.log_path,))
+        finally:
+            MATCH_INDEX = None  # the workers have their own copies now
+
+    def add(self, key):
+        self.added.append(key)
+
+    def match(self, keys):
+        """
+        Run find_match_candidate for each key against the index, in parallel.
+
+        Returns:
+            {key: (ngram_dist, matching_key) or None}
+        """
+        if self.added:
+            data = marshal.dumps(self.added)
+            self.log.write(struct.pack('<I', len(data)) + data)
+            self.log.flush()
+            self.added = []
+        keys = list(set(keys))
+        if not keys:
+            return {}
+        log_end = self.log.tell()
+        chunks = [(keys[n::self.jobs * 4], log_end) for n in xrange(self.jobs * 4)]
+        matches = {}
+        for chunk_matches, counters, ngram_counts in self.pool.imap_unordered(
+                match_batch_worker, chunks):
+            matches.update(chunk_matches)
+            # counted in a worker process
+            STATS.counters.update(counters)
+            NGRAM_CACHE.update(ngram_counts)
+        return matches
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.log.close()
+        os.remove(self.log_path)
+
+    def terminate(self):
+        self.pool.terminate()
+        self.log.close()
+        os.remove(self.log_path)
+
+
+MATCH_LOG = None  # a MatchPool worker's log of keys added to the index, and its position
+
+
+def init_match_worker(log_path):
+    global MATCH_LOG  # pylint: disable=global-statement
+    init_worker()
+    MATCH_LOG = [open(log_path, 'rb'), 0]
+
+
+def match_batch_worker((keys, log_end)):
+    counters = STATS.snapshot()
+    log, pos = MATCH_LOG
+    if pos < log_end:
+        log.seek(pos)
+        data = log.read(log_end - pos)
+        offset = 0
+        while offset < len(data):
+            size, = struct.unpack_from('<I', data, offset)
+            for key in marshal.loads(data[offset + 4:offset + 4 + size]):
+                MATCH_INDEX.add(key)
+            offset += 4 + size
+        MATCH_LOG[1] = log_end
+    matches = {key: find_match_candidate(key, MATCH_INDEX) for key in keys}
+    return matches, STATS.snapshot() - counters, NGRAM_CACHE.pop_new()
+
+
+def cluster_membership(clustered_local, clustered):
+    """
+    Find which global cluster each local cluster was merged into.
+
+    A failure's test name, build, and text determine its local cluster, so they're
+    enough to look up where the local cluster ended up.
+
+    Returns:
+        {test_name: {failure_text: global_key, ...}, ...}
+    """
+    global_keys = {}
+    for key, tests in clustered.iteritems():
+        for test_name, failures in tests.iteritems():
+            for failure in failures:
+                global_keys[test_name, failure.get('build'), failure['failure_text']] = key
+    membership = {}
+    for test_name, clusters in clustered_local.iteritems():
+        for key, failures in clusters.iteritems():
+            failure = failures[0]
+            global_key = global_keys.get((test_name, failure.get('build'),
+                                          failure['failure_text']))
+            if global_key:
+                membership.setdefault(test_name, {})[key] = global_key
+    return membership
+
+
+def cluster_incremental(failed_tests, previous_clustered, state_path, jobs=1):
+    """
+    Cluster failures by updating the clusters saved in state_path by the previous run.
+
+    Failures from builds that no longer have any failures (because they fell out of the
+    window) are expired, and only failures from builds that the previous run didn't
+    see are normalized and clustered. Local clusters keep their previous global cluster.
+
+    Returns:
+        (clustered_local, clustered), as from cluster_local and cluster_global.
+    """
+    state = load_cluster_state(state_path)
+    seen_builds = set(state['builds'])
+    current_builds = {t.get('build') for tests in failed_tests.itervalues() for t in tests}
+
+    clustered_local = {}
+    work = []
+    for test_name, tests in failed_tests.iteritems():
+        clusters = expire_failures(state['local'].get(test_name, {}), current_builds)
+        new_tests = [t for t in tests if t.get('build') not in seen_builds]
+        if new_tests:
+            work.append((test_name, new_tests, clusters))
+        elif clusters:
+            clustered_local[test_name] = clusters
+    print 'incremental: %d new builds, %d tests with new failures' % (
+        len(current_builds - seen_builds), len(work))
+    clustered_local.update(cluster_tests(work, jobs))
+
+    clustered = cluster_global.__wrapped__(
+        clustered_local, previous_clustered, state['membership'], jobs)
+
+    save_cluster_state(state_path, {
+        'builds': sorted(current_builds),
+        'local': clustered_local,
+        'membership': cluster_membership(clustered_local, clustered),
+    })
+
+    return clustered_local, clustered
+
+
+def load_cluster_state(state_path):
+    """Load the state saved by cluster_incremental, or the empty state for the first run."""
+    if not os.path.exists(state_path):
+        return {'builds': [], 'local': {}, 'membership': {}}
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def save_cluster_state(state_path, state):
+    """Save cluster_incremental's state, replacing the previous state only once it's written."""
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.rename(state_path + '.tmp', state_path)
+
+
+def expire_failures(clusters, current_builds):
+    """Drop failures from builds not in current_builds, and clusters left empty."""
+    kept = {}
+    for key, failures in clusters.iteritems():
+        failures = [f for f in failures if f.get('build') in current_builds]
+        if failures:
+            kept[key] = failures
+    return kept
 
 
 def tests_group_by_job(tests, builds):
@@ -318,19 +1084,25 @@ def common_spans(xs):
 
     Returns a list of [matchlen_1, mismatchlen_2, matchlen_2, mismatchlen_2, ...], representing
     sequences of the first element of the list that are present in all members.
+
+    Large clusters mostly repeat the same few texts, so each distinct text is only
+    tokenized once, and tokenizing stops once nothing is common to all of them.
     """
-    common = None
+    first_split = SPAN_RE.findall(xs[0])
+    common = set(first_split)
+    seen = {xs[0]}
     for x in xs:
-        x_split = SPAN_RE.findall(x)
-        if common is None:  # first iteration
-            common = set(x_split)
-        else:
-            common.intersection_update(x_split)
+        if not common:
+            break
+        if x in seen:
+            continue
+        seen.add(x)
+        common.intersection_update(SPAN_RE.findall(x))
 
     spans = []
     match = True
     span_len = 0
-    for x in SPAN_RE.findall(xs[0]):
+    for x in first_split:
         if x in common:
             if not match:
                 match = True
@@ -419,38 +1191,72 @@ def render(builds, clustered):
             'builds': builds_to_columns(builds)}
 
 
+class OwnerTrie(object):
+    """
+    A character trie over the test name prefixes in owners.json.
+
+    match returns the same owner as trying each SIG's prefixes in turn would, without a
+    regex: the first SIG in iteration order with a prefix of the name wins, regardless of
+    prefix length.
+    """
+
+    def __init__(self, owners):
+        self.root = {}
+        for order, (sig, prefixes) in enumerate(owners.iteritems()):
+            for prefix in prefixes:
+                node = self.root
+                for c in prefix:
+                    node = node.setdefault(c, {})
+                # None can't collide with a character, so it marks the end of a prefix.
+                if None not in node or node[None][0] > order:
+                    node[None] = (order, sig)
+
+    def match(self, name):
+        """Return the SIG owning the test name, or None."""
+        ends = []
+        node = self.root
+        for c in name:
+            if None in node:
+                ends.append(node[None])
+            node = node.get(c)
+            if node is None:
+                break
+        else:
+            if None in node:
+                ends.append(node[None])
+        return min(ends)[1] if ends else None
+
+
+def builds_started_by_job(builds, job_paths):
+    """
+    Return {job_name: {build_number: started}}, to count builds without formatting their paths.
+    """
+    started_by_path = {}
+    for path, build in builds.iteritems():
+        started_by_path.setdefault(path[:path.rindex('/')], {})[build['number']] = \
+            build['started']
+    return {job: started_by_path[path] for job, path in job_paths.iteritems()}
+
+
 def annotate_owners(data, builds, owners):
     """
     Assign ownership to a cluster based on the share of hits in the last day.
     """
-    owner_re = re.compile(r'(?:%s)' % '|'.join(
-        '(?P<%s>%s)' % (
-            sig.replace('-', '_'),  # regex group names can't have -
-            '|'.join(re.escape(p) for p in prefixes)
-        )
-        for sig, prefixes in owners.iteritems()
-    ))
-    job_paths = data['builds']['job_paths']
+    trie = OwnerTrie(owners)
+    owner_by_name = {}
+    started_by_job = builds_started_by_job(builds, data['builds']['job_paths'])
     yesterday = max(data['builds']['cols']['started']) - (60 * 60 * 24)
 
     for cluster in data['clustered']:
         owner_counts = {}
         for test in cluster['tests']:
-            m = owner_re.match(normalize_name(test['name']))
-            if not m:
-                continue
-            owner = next(k for k, v in m.groupdict().iteritems() if v)
-            owner = owner.replace('_', '-')
-            counts = owner_counts.setdefault(owner, [0, 0])
-            for job in test['jobs']:
-                if ':' in job['name']:  # non-standard CI
-                    continue
-                job_path = job_paths[job['name']]
-                for build in job['builds']:
-                    if builds['%s/%d' % (job_path, build)]['started'] > yesterday:
-                        counts[0] += 1
-                    else:
-                        counts[1] += 1
+            name = test['name']
+            if name not in owner_by_name:
+                owner_by_name[name] = trie.match(normalize_name(name))
+            owner = owner_by_name[name]
+            if owner:
+                count_owner_hits(owner_counts.setdefault(owner, [0, 0]), test['jobs'],
+                                 started_by_job, yesterday)
         if owner_counts:
             owner = max(owner_counts.items(), key=lambda (o, c): (c, o))[0]
             cluster['owner'] = owner
@@ -458,6 +1264,19 @@ def annotate_owners(data, builds, owners):
             cluster['owner'] = 'testing'
 
 
+def count_owner_hits(counts, jobs, started_by_job, yesterday):
+    """Add a test's builds in jobs to counts, [since yesterday, before yesterday]."""
+    for job in jobs:
+        if ':' in job['name']:  # non-standard CI
+            continue
+        started = started_by_job[job['name']]
+        for build in job['builds']:
+            if started[build] > yesterday:
+                counts[0] += 1
+            else:
+                counts[1] += 1
+
+
 def render_slice(data, builds, prefix='', owner=''):
     clustered = []
     builds_out = {}
@@ -479,54 +1298,202 @@ def render_slice(data, builds, prefix='', owner=''):
     return {'clustered': clustered, 'builds': builds_to_columns(builds_out)}
 
 
+def slice_names(owners=()):
+    """Return the names of every slice, in output order: each id prefix, then each owner."""
+    return ['%02x' % subset for subset in range(256)] + ['sig-' + owner for owner in owners]
+
+
+def render_slices(data, builds, owners=()):
+    """
+    Render every slice at once: the same output as render_slice for each two-character
+    id prefix, and for each owner.
+
+    The clusters are partitioned (and each slice's jobs collected) in one walk, builds
+    are grouped by job once, and builds_to_columns runs once per distinct set of jobs.
+
+    Returns:
+        {slice_name: slice_data}, with slice names as from slice_names(owners).
+    """
+    names = slice_names(owners)
+    clustered, jobs = partition_slices(data['clustered'], names, owners)
+    columns = slice_columns(jobs, builds)
+    return {name: {'clustered': clustered[name], 'builds': columns[name]} for name in names}
+
+
+def partition_slices(clusters, names, owners):
+    """
+    Return ({slice_name: [cluster, ...]}, {slice_name: set of job names}) for the
+    slices in names, in one walk over clusters.
+    """
+    owner_slices = {owner: 'sig-' + owner for owner in owners if owner}
+    clustered = {name: [] for name in names}
+    jobs = {name: set() for name in names}
+    for cluster in clusters:
+        slices = [cluster['id'][:2]]
+        if cluster.get('owner') in owner_slices:
+            slices.append(owner_slices[cluster['owner']])
+        cluster_jobs = {job['name'] for test in cluster['tests'] for job in test['jobs']}
+        for name in slices:
+            if name in clustered:
+                clustered[name].append(cluster)
+                jobs[name].update(cluster_jobs)
+    return clustered, jobs
+
+
+def slice_columns(jobs, builds):
+    """
+    Return {slice_name: builds_to_columns output} for {slice_name: set of job names}.
+
+    Builds are grouped by job once, and slices with the same jobs share their columns.
+    """
+    builds_by_job = {}
+    for path, build in builds.iteritems():
+        builds_by_job.setdefault(build['job'], {})[path] = build
+
+    columns = {}
+    out = {}
+    for name, job_names in jobs.iteritems():
+        job_set = frozenset(job_names)
+        if job_set not in columns:
+            builds_out = {}
+            for job in job_set:
+                builds_out.update(builds_by_job.get(job, {}))
+            columns[job_set] = builds_to_columns(builds_out)
+        out[name] = columns[job_set]
+    return out
+
+
+SLICES = None  # {slice_name: (slice_data, path)}, inherited by forked write_slice workers
+
+
+def write_slice_worker(name):
+    slice_data, path = SLICES[name]
+    with open(path, 'w') as f:
+        json.dump(slice_data, f, sort_keys=True)
+    return name
+
+
+def write_slices(data, builds, owners, path_template, jobs=1):
+    """Write every slice to path_template, with PREFIX replaced by the slice's name.
+
+    Serializing the slices dominates, so with jobs > 1 it's spread over worker processes.
+    """
+    global SLICES  # pylint: disable=global-statement
+    assert 'PREFIX' in path_template
+    SLICES = {name: (slice_data, path_template.replace('PREFIX', name))
+              for name, slice_data in render_slices(data, builds, owners).iteritems()}
+    try:
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                for _ in pool.imap_unordered(write_slice_worker, slice_names(owners)):
+                    pass
+            except KeyboardInterrupt:
+                pool.terminate()
+                raise
+            else:
+                pool.close()
+                pool.join()
+        else:
+            for name in slice_names(owners):
+                write_slice_worker(name)
+    finally:
+        SLICES = None
+
+
 def parse_args(args):
     parser = argparse.ArgumentParser()
     parser.add_argument('builds', help='builds.json file from BigQuery')
-    parser.add_argument('tests', help='tests.json file from BigQuery')
+    parser.add_argument('tests', nargs='?',
+                        help='tests.json file from BigQuery '
+                        '(not needed if builds includes tests, as emitted by kettle)')
     parser.add_argument('--previous', help='previous output', type=argparse.FileType('r'))
     parser.add_argument('--owners', help='test owner SIGs', type=argparse.FileType('r'))
     parser.add_argument('--output', default='failure_data.json')
+    parser.add_argument('--output_binary',
+                        help='Also output a memory-mappable binary file to this path')
+    parser.add_argument('--output_stats',
+                        help='Output per-stage timings and counters to this path '
+                        '(default: the --output path, ending in _stats.json)')
     parser.add_argument('--output_slices',
                         help='Output slices to this path (must include PREFIX in template)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes to cluster with')
+    parser.add_argument('--incremental',
+                        help='state file to update clusters from the previous run with')
+    parser.add_argument('--cache_dir',
+                        help='directory to save the results of slow stages in, keyed by '
+                        'their inputs (default: no caching)')
+    parser.add_argument('--cache_max_mb', type=int, default=STAGE_CACHE.max_bytes >> 20,
+                        help='remove the least recently used stage results past this size')
+    parser.add_argument('--invalidate_cache', action='store_true',
+                        help='remove all saved stage results before running')
+    parser.add_argument('--ngram_cache',
+                        help='file to load and save ngram counts between runs')
+    parser.add_argument('--ngram_cache_size', type=int, default=NGRAM_CACHE.max_size,
+                        help='maximum number of texts to keep ngram counts for')
     return parser.parse_args(args)
 
 
 def main(args):
-    builds, failed_tests = load_failures(args.builds, args.tests)
-    clustered_local = cluster_local(failed_tests)
+    STAGE_CACHE.path = args.cache_dir
+    STAGE_CACHE.max_bytes = args.cache_max_mb << 20
+    if args.invalidate_cache:
+        STAGE_CACHE.invalidate()
+
+    NGRAM_CACHE.max_size = args.ngram_cache_size
+    if args.ngram_cache:
+        NGRAM_CACHE.load(args.ngram_cache)
+
+    with STATS.stage('load_failures'):
+        builds, failed_tests = load_failures(args.builds, args.tests)
 
     previous_clustered = None
     if args.previous:
         print 'loading previous'
         previous_clustered = json.load(args.previous)['clustered']
-    clustered = cluster_global(clustered_local, previous_clustered)
+
+    if args.incremental:
+        with STATS.stage('cluster_incremental'):
+            _, clustered = cluster_incremental(
+                failed_tests, previous_clustered, args.incremental, args.jobs)
+    else:
+        with STATS.stage('cluster_local'):
+            clustered_local = cluster_local(failed_tests, args.jobs)
+        with STATS.stage('cluster_global'):
+            clustered = cluster_global(clustered_local, previous_clustered, jobs=args.jobs)
 
     print '%d clusters' % len(clustered)
 
-    data = render(builds, clustered)
+    with STATS.stage('render'):
+        data = render(builds, clustered)
 
     if args.owners:
-        owners = json.load(args.owners)
-        annotate_owners(data, builds, owners)
+        with STATS.stage('annotate_owners'):
+            owners = json.load(args.owners)
+            annotate_owners(data, builds, owners)
 
-    json.dump(data, open(args.output, 'w'),
-              sort_keys=True)
+    with STATS.stage('output'):
+        json.dump(data, open(args.output, 'w'),
+                  sort_keys=True)
 
-    if args.output_slices:
-        assert 'PREFIX' in args.output_slices
-        for subset in range(256):
-            id_prefix = '%02x' % subset
-            json.dump(render_slice(data, builds, id_prefix),
-                      open(args.output_slices.replace('PREFIX', id_prefix), 'w'),
-                      sort_keys=True)
-        if args.owners:
-            owners.setdefault('testing', [])  # for output
-            for owner in owners:
-                json.dump(render_slice(data, builds, prefix='', owner=owner),
-                          open(args.output_slices.replace('PREFIX', 'sig-' + owner), 'w'),
-                          sort_keys=True)
+        if args.output_binary:
+            binary_format.write(data, args.output_binary)
 
+    print 'ngram cache: %d hits, %d misses, %d entries' % (
+        NGRAM_CACHE.hits, NGRAM_CACHE.misses, len(NGRAM_CACHE))
+    if args.ngram_cache:
+        NGRAM_CACHE.save(args.ngram_cache)
 
+    if args.output_slices:
+        with STATS.stage('output_slices'):
+            slice_owners = []
+            if args.owners:
+                owners.setdefault('testing', [])  # for output
+                slice_owners = list(owners)
+            write_slices(data, builds, slice_owners, args.output_slices, args.jobs)
+
+    STATS.write(args.output_stats or os.path.splitext(args.output)[0] + '_stats.json')
 
 if __name__ == '__main__':
     main(parse_args(sys.argv[1:]))
@@ -0,0 +1,256 @@
+#!/usr/bin/env python2
+
+# Copyright 2017 The Kubernetes Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Benchmarks for the expensive parts of summarize.py.
+
+Run against a recorded failure corpus (the tests.json export that summarize.py reads):
+
+    pypy summarize_benchmark.py --tests triage_tests.json
+
+Without --tests, a synthetic corpus shaped like Kubernetes e2e failures is used.
+'''
+
+# pylint: disable=invalid-name,missing-docstring
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import berghelroach
+import summarize
+
+
+SYNTHETIC_TEMPLATES = [
+    'error during ./hack/ginkgo-e2e.sh --ginkgo.focus=%(word)s: exit status %(num)d',
+    '/go/src/k8s.io/kubernetes/_output/dockerized/go/src/k8s.io/kubernetes/test/e2e/%(word)s.go'
+    ':%(num)d\nExpected error:\n    <*errors.errorString | 0x%(hex)s>: {\n'
+    '        s: "timed out waiting for the condition",\n    }\n'
+    '    timed out waiting for the condition\nnot to have occurred',
+    '%(date)s Failed to create pod %(word)s-%(uuid)s on node e2e-test-minion-group-%(node)s:'
+    ' pods "%(word)s" is forbidden: exceeded quota',
+    'Expected\n    <map[string]string | len:2>: map[zone:%(word)s region:us-central1]\n'
+    'to equal\n    <map[string]string | len:2>: map[region:us-central1 zone:%(word)s]',
+    'Get https://%(ip)s/api/v1/namespaces/e2e-tests-%(word)s-%(node)s/pods: '
+    'dial tcp %(ip)s:443: getsockopt: connection refused',
+    'unexpected error in %(word)s: %(sentence)s',
+]
+
+WORDS = ('kubectl', 'services', 'networking', 'daemon', 'restart', 'volumes', 'scheduling',
+         'dns', 'ingress', 'autoscaling')
+VOCABULARY = ('pod', 'node', 'container', 'failed', 'timeout', 'waiting', 'for', 'the', 'to',
+              'condition', 'ready', 'running', 'expected', 'got', 'error', 'not', 'found')
+
+
+def synthetic_failures(count, seed=0):
+    rand = random.Random(seed)
+    failures = []
+    for _ in xrange(count):
+        template = rand.choice(SYNTHETIC_TEMPLATES)
+        failures.append(template % {
+            'word': rand.choice(WORDS),
+            'num': rand.randint(1, 999),
+            'hex': '%010x' % rand.getrandbits(40),
+            'uuid': '%08x-%04x-%04x-%04x-%012x' % tuple(
+                rand.getrandbits(n) for n in (32, 16, 16, 16, 48)),
+            'node': '%04x' % rand.getrandbits(16),
+            'ip': '.'.join(str(rand.randint(1, 254)) for _ in range(4)),
+            'sentence': ' '.join(rand.choice(WORDS + VOCABULARY)
+                                 for _ in xrange(rand.randint(5, 40))),
+            'date': 'Jun %2d %02d:%02d:%02d.%03d' % (
+                rand.randint(1, 30), rand.randint(0, 23), rand.randint(0, 59),
+                rand.randint(0, 59), rand.randint(0, 999)),
+        })
+    return failures
+
+
+def load_failures(path, count):
+    texts = [t['failure_text'] for t in json.load(open(path)) if t.get('failure_text')]
+    random.Random(0).shuffle(texts)
+    return texts[:count]
+
+
+def measure(description, func, *args):
+    start = time.time()
+    result = func(*args)
+    print >>sys.__stdout__, '%-40s %8.3fs' % (description, time.time() - start)
+    return result
+
+
+def find_match_sorted(fnorm, keys):
+    """find_match as it was before NgramIndex: sort every key by ngram distance."""
+    for ngram_dist, other in sorted((summarize.ngram_editdist(fnorm, x), x) for x in keys):
+        limit = int((len(fnorm)+len(other))/2.0 * 0.10)
+        if ngram_dist > limit:
+            continue
+        if limit <= 1 and other != fnorm:
+            continue
+        if summarize.editdist(fnorm, other, limit) < limit:
+            return other
+
+
+def bench_find_match(failures):
+    normalized = sorted(set(summarize.normalize(f) for f in failures))
+    # warm the ngram memo, so both paths are measured only on matching.
+    for key in normalized:
+        summarize.make_ngram_counts(key)
+
+    def cluster_sorted():
+        keys = []
+        for fnorm in normalized:
+            if not find_match_sorted(fnorm, keys):
+                keys.append(fnorm)
+        return keys
+
+    def cluster_index():
+        index = summarize.NgramIndex()
+        for fnorm in normalized:
+            if not summarize.find_match(fnorm, index):
+                index.add(fnorm)
+        return sorted(index.keys)
+
+    print '%d distinct normalized failures' % len(normalized)
+    expected = measure('find_match (sort all keys)', cluster_sorted)
+    actual = measure('find_match (NgramIndex)', cluster_index)
+    assert sorted(expected) == actual, 'clusterings differ!'
+
+
+def bench_cluster_global(failures):
+    failed_tests = {}
+    for n, text in enumerate(failures):
+        failed_tests.setdefault('test %d' % (n % 50), []).append({'failure_text': text})
+    clustered = summarize.cluster_local.__wrapped__(failed_tests)
+    print '%d local clusters' % sum(len(c) for c in clustered.itervalues())
+    # the progress output would swamp the timings
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        expected = measure('sequential', summarize.cluster_global.__wrapped__,
+                           clustered, None)
+        results = [(jobs, measure('%d jobs' % jobs, summarize.cluster_global.__wrapped__,
+                                  clustered, None, None, jobs))
+                   for jobs in (2, 4, 8)]
+    finally:
+        sys.stdout = stdout
+    for jobs, actual in results:
+        assert actual == expected, 'clusterings differ with %d jobs!' % jobs
+
+
+def bench_normalize(failures):
+    # each regex pass alone, so a regression in one of their costs stands out.
+    passes = [
+        ('date regex', lambda f: summarize.flakeReasonDateRE.sub('TIME', f)),
+        ('map[] regex', lambda f: summarize.flakeReasonMapRE.sub('', f)),
+        ('ordinal regex', lambda f: summarize.flakeReasonOrdinalRE.sub('', f)),
+        ('normalize', summarize.normalize),
+    ]
+    for description, func in passes:
+        measure(description, lambda: [func(f) for f in failures])
+    measure('normalize_batch', summarize.normalize_batch, failures)
+    # failures are normalized one test at a time, and tests repeat the same failures.
+    measure('normalize_batch (repeated failures)', summarize.normalize_batch,
+            [f for f in failures[:len(failures) / 10] for _ in range(10)])
+
+
+def bench_editdist(failures):
+    # compare each key to the candidates find_match would run editdist on.
+    keys = sorted(set(summarize.normalize_batch(failures)))
+    index = summarize.NgramIndex(keys)
+    pairs = []
+    for key in keys:
+        for _, other in index.candidates(key):
+            limit = int((len(key)+len(other))/2.0 * 0.10)
+            if limit > 1:
+                pairs.append((key, other, limit))
+    print '%d comparisons' % len(pairs)
+
+    def run(make_comparator):
+        results = []
+        comparators = {}
+        for key, other, limit in pairs:
+            comparator = comparators.get(key)
+            if comparator is None:
+                comparator = comparators[key] = make_comparator(key)
+            results.append(comparator.getDistance(other, limit) < limit)
+        return results
+
+    expected = measure('BerghelRoach per comparison',
+                       lambda: [berghelroach.dist(key, other, limit) < limit
+                                for key, other, limit in pairs])
+    for description, make_comparator in [
+            ('Comparator', berghelroach.Comparator),
+            ('Comparator (bitparallel)',
+             lambda key: berghelroach.Comparator(key, bitparallel=True))]:
+        assert measure(description, run, make_comparator) == expected, 'results differ!'
+
+
+def bench_stage_cache(failures):
+    # shaped like load_failures' results, with a few failures per test.
+    failed_tests = {}
+    for n, text in enumerate(failures):
+        failed_tests.setdefault('test %d' % (n % (len(failures) / 5 + 1)), []).append(
+            {'build': 'gs://logs/job/%d' % n, 'name': 'test', 'failure_text': text})
+    tmpdir = tempfile.mkdtemp(prefix='summarize_benchmark_')
+    try:
+        json_path = os.path.join(tmpdir, 'failed.json')
+        measure('json.dump', lambda: json.dump(failed_tests, open(json_path, 'w')))
+        cache = summarize.StageCache(tmpdir)
+        measure('StageCache.save', cache.save, 'failed', 'a' * 40, failed_tests)
+        print 'json %d bytes, stage cache %d bytes' % (
+            os.path.getsize(json_path), os.path.getsize(cache.entry_path('failed', 'a' * 40)))
+        expected = measure('json.load', lambda: json.load(open(json_path)))
+        actual = measure('StageCache.load', cache.load, 'failed', 'a' * 40)
+        assert expected == actual, 'results differ!'
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+BENCHMARKS = {
+    'cluster_global': bench_cluster_global,
+    'editdist': bench_editdist,
+    'find_match': bench_find_match,
+    'normalize': bench_normalize,
+    'stage_cache': bench_stage_cache,
+}
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmarks', nargs='*',
+                        help='benchmarks to run: %s (default: all)'
+                        % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--tests', help='tests.json file from BigQuery to take failures from')
+    parser.add_argument('--count', type=int, default=5000,
+                        help='number of failures to benchmark with')
+    return parser.parse_args(args)
+
+
+def main(args):
+    if args.tests:
+        failures = load_failures(args.tests, args.count)
+    else:
+        failures = synthetic_failures(args.count)
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        print '==', name
+        BENCHMARKS[name](failures)
+
+
+if __name__ == '__main__':
+    main(parse_args(sys.argv[1:]))
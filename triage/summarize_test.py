@@ -16,8 +16,10 @@
 
 # pylint: disable=invalid-name,missing-docstring
 
+import collections
 import json
 import os
+import random
 import unittest
 import shutil
 import tempfile
@@ -38,6 +40,10 @@ class StringsTest(unittest.TestCase):
         ]:
             self.assertEqual(summarize.normalize(src), dst)
 
+    def test_normalize_batch(self):
+        texts = ['0x1234 a', 'Mon, 12 January 2017 11:34:35 blah blah', '0x1234 a', 'map[b a]']
+        self.assertEqual(summarize.normalize_batch(texts), map(summarize.normalize, texts))
+
     def test_editdist(self):
         for a, b, expected in [
                 ('foob', 'food', 1),
@@ -56,9 +62,50 @@ class StringsTest(unittest.TestCase):
         # ensure stability of ngram count digest
         self.assertEqual(summarize.make_ngram_counts_digest('some string'), 'eddb950347d1eb05b5d7')
 
+    def test_ngram_cache(self):
+        cache = summarize.NgramCache(max_size=2)
+        a, b, c = [cache.key(s) for s in ('a', 'b', 'c')]
+        cache.put(a, [1])
+        cache.put(b, [2])
+        self.assertEqual(cache.get(a), [1])  # a is now more recent than b
+        cache.put(c, [3])
+        self.assertEqual(cache.get(b), None)
+        self.assertEqual(cache.get(c), [3])
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (2, 1, 2))
+
+    def test_ngram_cache_persistence(self):
+        tmpdir = tempfile.mkdtemp(prefix='summarize_test_')
+        try:
+            path = os.path.join(tmpdir, 'ngrams.bin')
+            cache = summarize.NgramCache()
+            cache.load(path)  # missing files are fine
+            key = cache.key(u'some string')
+            counts = summarize.make_ngram_counts(u'some string')
+            cache.put(key, counts)
+            cache.save(path)
+
+            loaded = summarize.NgramCache()
+            loaded.load(path)
+            self.assertEqual(loaded.get(key), counts)
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_ngram_editdist(self):
         self.assertEqual(summarize.ngram_editdist('example text', 'exampl text'), 1)
 
+    def test_ngram_index(self):
+        keys = ['exit 1', 'some long failure message', 'some long failure massage',
+                'some long failure message with a lot more text after it', 'x' * 100]
+        index = summarize.NgramIndex(keys)
+        for key in keys:
+            # same as sorting all keys by ngram distance, minus the ones exceeding the limit
+            expected = [(d, k) for d, k in sorted((summarize.ngram_editdist(key, k), k)
+                                                  for k in keys)
+                        if d <= int((len(key) + len(k)) / 2.0 * 0.10)]
+            self.assertEqual(list(index.candidates(key)), expected)
+        self.assertEqual(list(index.candidates('some long failure messages')),
+                         [(0, 'some long failure message'), (2, 'some long failure massage')])
+
     def test_common_spans(self):
         for a, b, expected in [
                 ('an exact match', 'an exact match', [14]),
@@ -66,6 +113,10 @@ class StringsTest(unittest.TestCase):
                 ('a problem with a common set', 'a common set', [2, 7, 1, 4, 13]),
         ]:
             self.assertEqual(summarize.common_spans([a, b]), expected)
+            # repeated texts don't change the result
+            self.assertEqual(summarize.common_spans([a] * 3 + [b] * 5 + [a]), expected)
+        self.assertEqual(summarize.common_spans(['some-text', 'other words', 'some-text']),
+                         [0, 9])
 
 
 class ClusterTest(unittest.TestCase):
@@ -85,9 +136,39 @@ class ClusterTest(unittest.TestCase):
         self.assertEqual(summarize.cluster_test([t1, t5, t6]),
                          {t1['failure_text']: [t1], t5['failure_text']: [t5, t6]})
 
+    def test_cluster_local(self):
+        failed_tests = {
+            'test a': [make_test('exit 1'), make_test('exit 2'), make_test('exit 1')],
+            'test b': [make_test('long message immediately preceding exit code 1'),
+                       make_test('long message immediately preceding exit code 2')],
+            'test c': [make_test('some other failure')],
+        }
+        clustered = summarize.cluster_local.__wrapped__(failed_tests)
+        self.assertEqual(clustered['test a'], {'exit 1': failed_tests['test a'][::2],
+                                               'exit 2': failed_tests['test a'][1:2]})
+        # clustering in parallel has identical results
+        self.assertEqual(summarize.cluster_local.__wrapped__(failed_tests, 2), clustered)
+
+    def test_cluster_local_ngram_cache(self):
+        # ngram counts made in worker processes are added to the parent's cache
+        texts = ['long message immediately preceding exit code 1', 'some other failure']
+        cache = summarize.NGRAM_CACHE
+        summarize.NGRAM_CACHE = summarize.NgramCache()
+        try:
+            summarize.cluster_local.__wrapped__(
+                {'test %d' % n: [make_test(text)] for n, text in enumerate(texts)}, 2)
+            for text in texts:
+                key = summarize.NGRAM_CACHE.key(summarize.normalize(text))
+                self.assertEqual(summarize.NGRAM_CACHE.get(key),
+                                 summarize.make_ngram_counts(summarize.normalize(text)))
+            self.assertIsNone(summarize.NGRAM_CACHE.new)  # only workers record new entries
+        finally:
+            summarize.NGRAM_CACHE = cache
+
     @staticmethod
-    def cluster_global(clustered, previous_clustered=None):
-        return summarize.cluster_global.__wrapped__(clustered, previous_clustered)
+    def cluster_global(clustered, previous_clustered=None, previous_membership=None):
+        return summarize.cluster_global.__wrapped__(
+            clustered, previous_clustered, previous_membership)
 
     def test_cluster_global(self):
         t1 = make_test('exit 1')
@@ -108,6 +189,250 @@ class ClusterTest(unittest.TestCase):
             self.cluster_global({'test a': {textNew: [t1]}}, [{'key': textOld}]),
             {textOld: {'test a': [t1]}})
 
+    def test_cluster_global_previous_membership(self):
+        # local clusters rejoin their previous global cluster, even if it's not the best match
+        t1 = make_test('exit 1')
+        self.assertEqual(
+            self.cluster_global({'test a': {'exit 1': [t1]}, 'test b': {'exit 1': [t1]}},
+                                None, {'test a': {'exit 1': 'exit 2'}}),
+            {'exit 2': {'test a': [t1]}, 'exit 1': {'test b': [t1]}})
+
+    def test_cluster_global_parallel(self):
+        rand = random.Random(0)
+        words = ['pod', 'node', 'timed', 'out', 'waiting', 'for', 'condition', 'failed']
+        texts = [' '.join(rand.choice(words) for _ in range(rand.randint(5, 30)))
+                 for _ in range(40)]
+        clustered = {}
+        for n in range(200):
+            text = rand.choice(texts)
+            if rand.random() < 0.5:  # a near duplicate
+                pos = rand.randint(0, len(text))
+                text = text[:pos] + rand.choice(words) + text[pos:]
+            clustered.setdefault('test %d' % (n % 20), {})[text] = [make_test(text)] * (n % 3 + 1)
+        previous = [{'key': text} for text in texts[:5]]
+        membership = {'test 1': {key: texts[6] for key in clustered['test 1']}}
+
+        expected = self.cluster_global(clustered, previous, membership)
+        for jobs in (2, 3):
+            self.assertEqual(summarize.cluster_global.__wrapped__(
+                clustered, previous, membership, jobs), expected)
+
+    def test_cluster_global_parallel_error(self):
+        # the MatchPool is stopped and its log removed if clustering fails
+        pools = []
+
+        class MatchPool(summarize.MatchPool):
+            def __init__(self, index, jobs):
+                super(MatchPool, self).__init__(index, jobs)
+                pools.append(self)
+
+        def find_global_match(*_args):
+            raise ValueError('no match')
+
+        orig = summarize.MatchPool, summarize.find_global_match
+        summarize.MatchPool, summarize.find_global_match = MatchPool, find_global_match
+        try:
+            with self.assertRaises(ValueError):
+                summarize.cluster_global.__wrapped__(
+                    {'test a': {'exit 1': [make_test('exit 1')]}}, None, None, 2)
+        finally:
+            summarize.MatchPool, summarize.find_global_match = orig
+        self.assertEqual(len(pools), 1)
+        self.assertFalse(os.path.exists(pools[0].log_path))
+
+    def test_match_pool(self):
+        def match(key, other):
+            return summarize.ngram_editdist(key, other), other
+
+        index = summarize.NgramIndex(['some long failure message'])
+        pool = summarize.MatchPool(index, 2)
+        try:
+            self.assertEqual(pool.match(['some long failure massage', 'exit 1']), {
+                'some long failure massage': match('some long failure massage',
+                                                   'some long failure message'),
+                'exit 1': None})
+            # keys added after the workers started are matched against too
+            index.add('another failure with different text')
+            pool.add('another failure with different text')
+            self.assertEqual(pool.match(['another failure with different test']), {
+                'another failure with different test': match(
+                    'another failure with different test', 'another failure with different text')})
+        finally:
+            pool.close()
+        self.assertFalse(os.path.exists(pool.log_path))
+
+    def test_cluster_incremental(self):
+        text = 'some long failure message that changes occasionally %s'
+        t1 = dict(make_test(text % 'foo'), build='gs://logs/job/1')
+        t2 = dict(make_test(text % 'bar'), build='gs://logs/job/2')
+        t3 = dict(make_test(text % 'baz'), build='gs://logs/job/3')
+        t4 = dict(make_test('some unrelated failure'), build='gs://logs/job/3')
+
+        tmpdir = tempfile.mkdtemp(prefix='summarize_test_')
+        try:
+            state = os.path.join(tmpdir, 'state.json')
+            local, clustered = summarize.cluster_incremental(
+                {'test a': [t1, t2], 'test b': [t2]}, None, state)
+            self.assertEqual(local, {'test a': {t1['failure_text']: [t1, t2]},
+                                     'test b': {t2['failure_text']: [t2]}})
+            self.assertEqual(clustered, {t1['failure_text']: {'test a': [t1, t2],
+                                                              'test b': [t2]}})
+
+            # build 1 falls out of the window, build 3 is new.
+            local, clustered = summarize.cluster_incremental(
+                {'test a': [t2, t3], 'test b': [t2, t4]}, None, state)
+            self.assertEqual(local, {'test a': {t1['failure_text']: [t2, t3]},
+                                     'test b': {t2['failure_text']: [t2],
+                                                t4['failure_text']: [t4]}})
+            self.assertEqual(clustered, {t1['failure_text']: {'test a': [t2, t3],
+                                                              'test b': [t2]},
+                                         t4['failure_text']: {'test b': [t4]}})
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_owner_trie(self):
+        owners = collections.OrderedDict([
+            ('node', ['Kubelet', 'Node Conformance']),
+            ('apps', ['Kubelet should', 'Deployment', 'Daemon']),
+            ('network', ['DNS', 'Networking', 'Net']),
+        ])
+        trie = summarize.OwnerTrie(owners)
+        self.assertEqual(trie.match('Kubelet should run pods'), 'node')
+        self.assertEqual(trie.match('Deployment should scale'), 'apps')
+        self.assertEqual(trie.match('Networking should work'), 'network')
+        self.assertEqual(trie.match('Net'), 'network')
+        self.assertEqual(trie.match('Ne'), None)
+        self.assertEqual(trie.match('Scheduler should schedule'), None)
+
+    def test_annotate_owners(self):
+        builds = {'gs://logs/job/%d' % n: {'job': 'job', 'number': n, 'started': n * 60 * 60,
+                                           'path': 'gs://logs/job/%d' % n}
+                  for n in range(1, 50)}
+        failures = lambda text, numbers: [
+            {'build': 'gs://logs/job/%d' % n, 'failure_text': text} for n in numbers]
+        clustered = {
+            'failure a': {'[k8s.io] Kubelet restarts': failures('a', range(1, 10))},
+            'failure b': {
+                # recent failures outweigh older ones
+                'Kubelet [Slow] restarts': failures('b', range(1, 20)),
+                'DNS [Conformance] resolves': failures('b', range(40, 49)),
+                '[k8s.io] Unowned': failures('b', [48])},
+            'failure c': {'Unowned test': failures('c', [1, 2])},
+        }
+        data = summarize.render(builds, clustered)
+        summarize.annotate_owners(data, builds, {'node': ['Kubelet'], 'network': ['DNS']})
+        self.assertEqual({c['key']: c['owner'] for c in data['clustered']},
+                         {'failure a': 'node', 'failure b': 'network', 'failure c': 'testing'})
+
+    def test_render_slices(self):
+        builds = {'gs://logs/job-%d/%d' % (j, n):
+                  {'job': 'job-%d' % j, 'number': n, 'path': 'gs://logs/job-%d/%d' % (j, n),
+                   'started': 1234 + n}
+                  for j in range(4) for n in range(1, 4)}
+        clustered = {'failure %d' % n: {'test %d' % n: [
+            {'build': 'gs://logs/job-%d/%d' % (n % 4, b), 'failure_text': 'failure %d' % n}
+            for b in (n % 3 + 1, 3)]} for n in range(10)}
+        data = summarize.render(builds, clustered)
+        for n, cluster in enumerate(data['clustered']):
+            cluster['owner'] = ['node', 'testing', 'other'][n % 3]
+        owners = ['node', 'testing', 'nobody']
+
+        self.assertEqual(len(data['clustered']), 10)
+
+        slices = summarize.render_slices(data, builds, owners)
+        self.assertEqual(sorted(slices), sorted(summarize.slice_names(owners)))
+        for subset in range(256):
+            self.assertEqual(slices['%02x' % subset],
+                             summarize.render_slice(data, builds, '%02x' % subset))
+        for owner in owners:
+            self.assertEqual(slices['sig-' + owner],
+                             summarize.render_slice(data, builds, owner=owner))
+
+
+class StageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='summarize_test_')
+        summarize.STAGE_CACHE.path = os.path.join(self.tmpdir, 'cache')
+        self.calls = []
+
+        @summarize.stage_cache('reading', 'read', files=('path',), ignore=('jobs',))
+        def read(path, jobs=1):
+            self.calls.append(('read', path, jobs))
+            return open(path).read(), {'jobs': jobs}
+
+        @summarize.stage_cache('counting', 'count')
+        def count(data):
+            self.calls.append(('count', data))
+            return len(data)
+
+        self.read = read
+        self.count = count
+
+    def tearDown(self):
+        summarize.STAGE_CACHE.path = None
+        shutil.rmtree(self.tmpdir)
+
+    def test_stage_cache(self):
+        path = os.path.join(self.tmpdir, 'input.txt')
+        with open(path, 'w') as f:
+            f.write('some input')
+
+        self.assertEqual(self.read(path), ('some input', {'jobs': 1}))
+        self.assertEqual(self.read(path, jobs=2), ('some input', {'jobs': 1}))  # cached
+        self.assertEqual(self.count(self.read(path)[0]), 10)
+        self.assertEqual(self.count(self.read(path)[0]), 10)
+        self.assertEqual(self.calls, [('read', path, 1), ('count', 'some input')])
+
+        # changing the input file invalidates every stage that depends on it
+        with open(path, 'w') as f:
+            f.write('other input!')
+        self.assertEqual(self.count(self.read(path)[0]), 12)
+        self.assertEqual(len(self.calls), 4)
+
+        summarize.STAGE_CACHE.invalidate()
+        self.assertEqual(self.count(self.read(path)[0]), 12)
+        self.assertEqual(len(self.calls), 6)
+
+    def test_load_failures_interned(self):
+        # strings are shared in results loaded from the cache, as in computed ones
+        builds_path = os.path.join(self.tmpdir, 'builds.json')
+        tests_path = os.path.join(self.tmpdir, 'tests.json')
+        build = {'started': 1234, 'number': 1, 'tests_failed': 2, 'tests_run': 2,
+                 'path': 'gs://logs/some-job/1', 'job': 'some-job', 'result': 'FAILURE'}
+        json.dump([build], open(builds_path, 'w'))
+        json.dump([{'name': 'test %d' % n, 'build': build['path'], 'failure_text': 'exit 1'}
+                   for n in range(2)], open(tests_path, 'w'))
+        computed = summarize.load_failures(builds_path, tests_path)
+        cached = summarize.load_failures(builds_path, tests_path)
+        self.assertEqual(cached, computed)
+        builds, failed_tests = cached
+        (path, build), = builds.items()
+        (test_a,), (test_b,) = failed_tests.values()
+        self.assertIs(test_a['failure_text'], test_b['failure_text'])
+        self.assertIs(test_a['build'], path)
+        self.assertIs(build['path'], path)
+        for name, (test,) in failed_tests.iteritems():
+            self.assertIs(test['name'], name)
+
+    def test_stage_cache_cleanup(self):
+        cache = summarize.StageCache(os.path.join(self.tmpdir, 'cleanup'), max_bytes=0)
+        cache.save('stage', 'a' * 40, range(100))
+        cache.save('stage', 'b' * 40, range(100))
+        # only the entry just saved is kept
+        self.assertEqual(cache.load('stage', 'a' * 40), None)
+        self.assertEqual(cache.load('stage', 'b' * 40), range(100))
+
+    def test_stage_cache_other_files(self):
+        # files in the cache's directory that aren't its entries are left alone
+        cache = summarize.StageCache(os.path.join(self.tmpdir, 'other'), max_bytes=0)
+        cache.save('stage', 'a' * 40, range(100))
+        other = os.path.join(cache.path, 'notes.txt')
+        with open(other, 'w') as f:
+            f.write('not an entry' * 100)
+        cache.save('stage', 'b' * 40, range(100))
+        cache.invalidate()
+        self.assertEqual(os.listdir(cache.path), ['notes.txt'])
+
 
 ############ decode JSON without a bunch of unicode garbage
 ### http://stackoverflow.com/a/33571117
@@ -144,6 +469,31 @@ class IntegrationTest(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.tmpdir)
 
+    def test_load_failures_ndjson(self):
+        build = {'started': 1234, 'number': 1, 'tests_failed': 1, 'tests_run': 2, 'elapsed': 4,
+                 'path': 'gs://logs/some-job/1', 'job': 'some-job', 'result': 'FAILURE'}
+        test = {'name': 'example test', 'build': 'gs://logs/some-job/1',
+                'failure_text': 'some awful stack trace exit 1'}
+        json.dump([build], open('builds.json', 'w'))
+        json.dump([test], open('tests.json', 'w'))
+        expected = summarize.load_failures.__wrapped__('builds.json', 'tests.json')
+
+        # newline-delimited rows
+        with open('builds.ndjson', 'w') as f:
+            f.write(json.dumps(dict(build, version='v1.2.3')) + '\n\n')
+        with open('tests.ndjson', 'w') as f:
+            f.write(json.dumps(test) + '\n')
+        self.assertEqual(
+            summarize.load_failures.__wrapped__('builds.ndjson', 'tests.ndjson'), expected)
+
+        # kettle rows, with tests embedded in builds
+        with open('kettle.json', 'w') as f:
+            f.write(json.dumps(dict(build, test=[
+                {'name': 'example test', 'failed': True, 'time': 1.0,
+                 'failure_text': 'some awful stack trace exit 1'},
+                {'name': 'passing test', 'time': 2.0}])) + '\n')
+        self.assertEqual(summarize.load_failures.__wrapped__('kettle.json'), expected)
+
     def test_main(self):
         def smear(l):
             "given a list of dictionary deltas, return a list of dictionaries"
@@ -233,6 +583,13 @@ class IntegrationTest(unittest.TestCase):
         self.assertEqual(slice_output['clustered'], [output['clustered'][0]])
         self.assertEqual(slice_output['builds']['cols']['started'], [1234, 1234, 1234, 1234])
 
+        stats = json.load(open('failure_data_stats.json'))
+        self.assertEqual([stage['name'] for stage in stats['stages']],
+                         ['load_failures', 'cluster_local', 'cluster_global', 'render',
+                          'annotate_owners', 'output', 'output_slices'])
+        self.assertIn('normalize_memo_hit_rate', stats['stages'][1])
+        self.assertGreater(stats['stages'][2]['counters']['ngram_checks'], 0)
+
 
 if __name__ == '__main__':
     unittest.main()
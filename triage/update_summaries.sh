@@ -30,7 +30,6 @@ if [[ ! -e triage_builds.json ]] || [ $(stat -c%Y triage_builds.json) -lt $table
   echo "UPDATING" $table_mtime
   bq --headless --format=json query -n 1000000 'select path, timestamp_to_sec(started) started, elapsed, tests_run, tests_failed, result, executor, job, number from [k8s-gubernator:build.week]' > triage_builds.json
   bq --headless --format=json query -n 10000000 'select path build, test.name name, test.failure_text failure_text from [k8s-gubernator:build.week] where test.failed' > triage_tests.json
-  rm -f failed*.json
 fi
 #
 
@@ -41,12 +40,20 @@ mkdir -p slices
 
 pypy summarize.py triage_builds.json triage_tests.json \
   --previous failure_data_previous.json --owners test_owners.json \
-  --output failure_data.json --output_slices slices/failure_data_PREFIX.json
+  --output failure_data.json --output_binary failure_data.bin \
+  --output_slices slices/failure_data_PREFIX.json \
+  --jobs $(nproc) --ngram_cache ngram_cache.bin --incremental triage_state.json \
+  --cache_dir stage_cache
 
 gsutil_cp() {
   gsutil -h 'Cache-Control: no-store, must-revalidate' -m cp -Z -a public-read "$@"
 }
 
 gsutil_cp failure_data.json gs://k8s-gubernator/triage/
+# not gzipped, so it can be read with range requests or memory-mapped after download.
+gsutil -h 'Cache-Control: no-store, must-revalidate' cp -a public-read \
+  failure_data.bin gs://k8s-gubernator/triage/
 gsutil_cp slices/*.json gs://k8s-gubernator/triage/slices/
 gsutil_cp failure_data.json "gs://k8s-gubernator/triage/history/$(date -u +%Y%m%d).json"
+gsutil_cp failure_data_stats.json \
+  "gs://k8s-gubernator/triage/history/$(date -u +%Y%m%d)_stats.json"